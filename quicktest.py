@@ -95,6 +95,8 @@ class QuickDjangoTest(object):
             DEBUG = True,
             DATABASES = {
                 'default': database,
+                # the second database for tests of moving of owners between shards
+                'shard': dict(database, NAME=database['NAME'] + '_shard'),
             },
             INSTALLED_APPS = self.INSTALLED_APPS + INSTALLED_APPS + self.apps,
             **settings_test
@@ -3,6 +3,27 @@ from django.contrib import admin
 from django.core.urlresolvers import reverse
 from vkontakte_api.admin import VkontakteModelAdmin
 from models import Album, Photo
+from routers import use_primary
+
+
+class PrimaryChangeModelAdmin(VkontakteModelAdmin):
+
+    """
+    Admin, reading objects from primary database in views, changing them.
+    Changelists are read from replicas by ReplicaRouter
+    """
+
+    def add_view(self, *args, **kwargs):
+        with use_primary():
+            return super(PrimaryChangeModelAdmin, self).add_view(*args, **kwargs)
+
+    def change_view(self, *args, **kwargs):
+        with use_primary():
+            return super(PrimaryChangeModelAdmin, self).change_view(*args, **kwargs)
+
+    def delete_view(self, *args, **kwargs):
+        with use_primary():
+            return super(PrimaryChangeModelAdmin, self).delete_view(*args, **kwargs)
 
 
 class PhotoInline(admin.TabularInline):
@@ -19,7 +40,7 @@ class PhotoInline(admin.TabularInline):
     can_delete = False
 
 
-class AlbumAdmin(VkontakteModelAdmin):
+class AlbumAdmin(PrimaryChangeModelAdmin):
 
     def image_preview(self, obj):
         return u'<a href="%s"><img src="%s" height="30" /></a>' % (obj.thumb_src, obj.thumb_src)
@@ -32,7 +53,7 @@ class AlbumAdmin(VkontakteModelAdmin):
     inlines = [PhotoInline]
 
 
-class PhotoAdmin(VkontakteModelAdmin):
+class PhotoAdmin(PrimaryChangeModelAdmin):
 
     def image_preview(self, obj):
         return u'<a href="%s"><img src="%s" height="30" /></a>' % (obj.photo_604, obj.photo_130)
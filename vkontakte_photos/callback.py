@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F
+from django.utils import timezone
+from vkontakte_api.decorators import atomic
+from vkontakte_comments.models import Comment
+from vkontakte_groups.models import Group
+from vkontakte_users.models import User
+
+from .models import Album, CallbackEvent, Photo
+from .routers import PRIMARY_DATABASE, get_shard, use_primary
+
+log = logging.getLogger('vkontakte_photos')
+
+CALLBACK_SECRET = getattr(settings, 'VKONTAKTE_PHOTOS_CALLBACK_SECRET', '')
+CALLBACK_CONFIRMATION = getattr(settings, 'VKONTAKTE_PHOTOS_CALLBACK_CONFIRMATION', '')
+CALLBACK_BATCH_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_CALLBACK_BATCH_SIZE', 100)
+CALLBACK_BATCH_TIMEOUT = getattr(settings, 'VKONTAKTE_PHOTOS_CALLBACK_BATCH_TIMEOUT', 5)  # seconds
+
+PHOTO_EVENTS = ('photo_new',)
+COMMENT_EVENTS = ('photo_comment_new', 'photo_comment_edit', 'photo_comment_restore', 'photo_comment_delete')
+
+
+class CallbackHandler(object):
+
+    """
+    Handler of VK Callback API events. Every event is stored in table of CallbackEvent and acknowledged
+    right after that, so acknowledged events survive restarts of process and failures of processing don't
+    make VK resend them. Stored events are processed in micro-batches of `batch_size` events by command
+    vkontakte_photos_callback, waiting `batch_timeout` seconds for new events. If processing of batch fails,
+    its events are processed one by one, failed events are logged and dropped, so the queue keeps draining
+    """
+
+    def __init__(self, secret=CALLBACK_SECRET, batch_size=CALLBACK_BATCH_SIZE, batch_timeout=CALLBACK_BATCH_TIMEOUT):
+        self.secret = secret
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+    def verify(self, event):
+        # events are never accepted without secret key, otherwise anybody could forge photos and comments
+        return bool(self.secret) and event.get('secret') == self.secret
+
+    @use_primary()
+    def handle(self, event):
+        if event['type'] not in PHOTO_EVENTS + COMMENT_EVENTS:
+            log.debug('Skipped callback event with type "%s"' % event['type'])
+            return
+
+        CallbackEvent.objects.create(type=event['type'], data=json.dumps(event['object']), received=timezone.now())
+
+    @use_primary()
+    def flush(self):
+        """
+        Process all pending stored events batch by batch. Return number of processed events
+        """
+        count = 0
+        while True:
+            try:
+                processed = self.flush_batch(CallbackEvent.objects.all())
+                if not processed:
+                    break
+            except Exception:
+                log.exception('Failed processing of batch of callback events, processing them one by one')
+                processed, dropped = self.flush_separately()
+                if not processed and not dropped:
+                    break
+            count += processed
+        return count
+
+    def flush_batch(self, queryset):
+        """
+        Process and delete batch of pending events of `queryset` in one transaction. Return number of them
+        """
+        with atomic(using=PRIMARY_DATABASE):
+            # events, locked by another process, are waited for and skipped after it deletes them
+            events = list(queryset.select_for_update().order_by('pk')[:self.batch_size])
+            if events:
+                self.process([{'type': event.type, 'object': json.loads(event.data)} for event in events])
+                CallbackEvent.objects.filter(pk__in=[event.pk for event in events]).delete()
+        return len(events)
+
+    def flush_separately(self):
+        """
+        Process the oldest batch of pending events one by one, every event in a separate transaction.
+        Failed events are logged and dropped. Return tuple of numbers of processed and dropped events
+        """
+        processed, dropped = 0, 0
+        for event in CallbackEvent.objects.order_by('pk')[:self.batch_size]:
+            try:
+                processed += self.flush_batch(CallbackEvent.objects.filter(pk=event.pk))
+            except Exception:
+                log.exception('Dropped callback event "%s" with data %s after failed processing' % (
+                    event.type, event.data))
+                CallbackEvent.objects.filter(pk=event.pk).delete()
+                dropped += 1
+        return processed, dropped
+
+    def process(self, events):
+        self.process_photos([event['object'] for event in events if event['type'] in PHOTO_EVENTS])
+        self.process_comments([event for event in events if event['type'] in COMMENT_EVENTS])
+        log.debug('Processed batch of %d callback events' % len(events))
+
+    def process_photos(self, resources):
+        if not resources:
+            return
+
+        # photos of service albums (wall, profile, saved) have negative album ids, they are not stored
+        photos = [photo for photo in Photo.remote.parse_response_list(resources, {'fetched': timezone.now()})
+                  if photo.album_id > 0]
+        albums_ids = {}
+        for photo in photos:
+            albums_ids.setdefault(photo.owner, set()).add(photo.album_id)
+        for owner, ids in albums_ids.items():
+            Album.remote.create_missing(owner, ids)
+
+        Photo.remote.get_or_create_from_instances(photos)
+
+    def process_comments(self, events):
+        if not events:
+            return
+
+        photos = self.get_photos(events)
+        comments_counts = {}
+        for event in events:
+            resource = dict(event['object'])
+            photo = photos.get(resource.pop('photo_id'))
+            if not photo:
+                log.warning('Skipped callback event "%s" for unknown photo' % event['type'])
+                continue
+
+            remote_id = '%s_%s' % (photo.owner_remote_id, resource['id'])
+            if event['type'] == 'photo_comment_delete':
+                if Comment.objects.filter(remote_id=remote_id, archived=False).update(archived=True):
+                    comments_counts[photo.pk] = comments_counts.get(photo.pk, 0) - 1
+                continue
+
+            created = not Comment.objects.filter(remote_id=remote_id, archived=False).exists()
+            resource.pop('photo_owner_id', None)
+            comment = Comment.remote.parse_response_dict(resource, {
+                'object': photo,
+                'owner': photo.owner,
+                'fetched': timezone.now(),
+            })
+            Comment.remote.get_or_create_from_instance(comment)
+            if created:
+                comments_counts[photo.pk] = comments_counts.get(photo.pk, 0) + 1
+
+        for pk, delta in comments_counts.items():
+            Photo.objects.using(photos[pk]._state.db).filter(pk=pk).update(
+                comments_count=F('comments_count') + delta, actions_count=F('actions_count') + delta)
+
+    def get_photos(self, events):
+        """
+        Return dict of stored photos of comments events, looking them up in shard databases of their owners
+        """
+        shards = {}
+        for event in events:
+            owner_id = event['object'].get('photo_owner_id')
+            shard = get_shard(ContentType.objects.get_for_model(Group if owner_id < 0 else User).pk, abs(owner_id)) \
+                if owner_id else None
+            shards.setdefault(shard, set()).add(event['object']['photo_id'])
+
+        photos = {}
+        for shard, ids in shards.items():
+            photos.update(Photo.objects.db_manager(shard).in_bulk(ids))
+        return photos
+
+
+handler = CallbackHandler()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from django.utils.functional import wraps
+from vkontakte_api.decorators import atomic
+
+from .routers import SHARD_DATABASES, get_current_database, get_object_shard, use_primary, use_shard
+
+
+def atomic_fetch(func):
+    """
+    Manager method decorator, wraps the whole fetching in a single transaction
+    if commit granularity `commit_every` is not defined for the call or for the manager.
+    Otherwise transactions are managed by CommitEveryManagerMixin. Reads during fetching are sent to primary database
+    """
+    def wrapper(self, *args, **kwargs):
+        with use_primary():
+            if self.get_commit_every(kwargs):
+                return func(self, *args, **kwargs)
+            with atomic(using=get_current_database()):
+                return func(self, *args, **kwargs)
+
+    return wraps(func)(wrapper)
+
+
+def owner_shard(func):
+    """
+    Manager method decorator, routing queries of sharded models inside the method to shard database of owner,
+    defined by argument `album`, `owner`, `user`, `group` or by the first positional argument
+    """
+    def wrapper(self, *args, **kwargs):
+        for name in ['album', 'owner', 'user', 'group']:
+            if kwargs.get(name):
+                obj = kwargs[name]
+                break
+        else:
+            obj = args[0] if args else None
+
+        with use_shard(get_object_shard(obj)):
+            return func(self, *args, **kwargs)
+
+    return wraps(func)(wrapper)
+
+
+def split_by_shards(func):
+    """
+    Manager method decorator for methods of many owners, albums or photos, passed by the first argument.
+    Method is called for every shard of them separately. List of all instances of returned querysets
+    is returned with and without sharding, because querysets of different databases can not be combined
+    """
+    def wrapper(self, objects, *args, **kwargs):
+        if not SHARD_DATABASES:
+            return list(func(self, objects, *args, **kwargs))
+
+        shards = {}
+        for obj in objects:
+            shards.setdefault(get_object_shard(obj), []).append(obj)
+
+        result = []
+        for shard, objects in shards.items():
+            with use_shard(shard):
+                result += list(func(self, objects, *args, **kwargs))
+        return result
+
+    return wraps(func)(wrapper)
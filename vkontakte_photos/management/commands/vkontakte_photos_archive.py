@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from vkontakte_photos.models import PhotoArchive, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+from vkontakte_photos.routers import use_shard
+
+
+class Command(BaseCommand):
+
+    help = 'Move archived photos from the live table of photos into archive table. Can be interrupted and resumed'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', action='store', type='int', dest='days', default=ARCHIVE_AFTER_DAYS,
+                    help='Move photos, fetched last time more than this number of days ago'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=ARCHIVE_BATCH_SIZE,
+                    help='Number of photos, moved in one transaction'),
+        make_option('--database', action='store', dest='database', default=None,
+                    help='Shard database to move photos in'),
+    )
+
+    def handle(self, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        with use_shard(options['database']):
+            count = PhotoArchive.objects.move(before=before, batch_size=options['batch_size'])
+        self.stdout.write('Moved %d photos into archive\n' % count)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from vkontakte_groups.models import Group
+from vkontakte_users.models import User
+
+from vkontakte_photos.models import Album, Photo
+
+OWNER_MODELS = {'group': Group, 'user': User}
+
+
+class Command(BaseCommand):
+
+    help = 'Initial loading of all albums and photos of new owners, saving them in bulk'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--owner', action='append', dest='owners', default=[],
+                    help='Owner to load in format "group:ID" or "user:ID", can be repeated'),
+    )
+
+    def handle(self, **options):
+        if not options['owners']:
+            raise CommandError('Specify at least one owner with option --owner')
+
+        owners = []
+        for owner in options['owners']:
+            try:
+                type_name, owner_id = owner.split(':')
+                owners += [(OWNER_MODELS[type_name], int(owner_id))]
+            except (KeyError, ValueError):
+                raise CommandError('Wrong format of owner "%s", should be "group:ID" or "user:ID"' % owner)
+
+        for model, owner_id in owners:
+            owner = model.remote.fetch(ids=[owner_id])[0]
+            albums = Album.remote.fetch(owner=owner, backfill=True)
+            # counters of photos are returned only in extended response, otherwise stored ones are overwritten by zeros
+            photos = Photo.remote.fetch_all_for_owner(owner, extended=True, backfill=True)
+            self.stdout.write('Loaded %d albums and %d photos of owner %s\n' % (albums.count(), photos.count(), owner))
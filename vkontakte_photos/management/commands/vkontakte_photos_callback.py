@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from vkontakte_photos.callback import handler
+
+
+class Command(BaseCommand):
+
+    help = 'Process stored events of VK Callback API, waiting for processing in batch'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Run continuously, waiting for new events'),
+        make_option('--sleep', action='store', type='int', dest='sleep', default=handler.batch_timeout,
+                    help='Seconds of waiting for new events in continuous mode'),
+    )
+
+    def handle(self, **options):
+        while True:
+            count = handler.flush()
+            if count or not options['loop']:
+                self.stdout.write('Processed %d callback events\n' % count)
+
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
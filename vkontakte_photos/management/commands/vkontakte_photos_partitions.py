@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from vkontakte_photos.partitioning import PhotoPartitioner, PARTITIONS_AHEAD
+
+
+class Command(BaseCommand):
+
+    help = 'Create monthly partitions of table of photos ahead of time. Run it by cron at least once a month'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--convert', action='store_true', dest='convert', default=False,
+                    help='Convert existing table of photos into partitioned by date, if it is not partitioned yet'),
+        make_option('--ahead', action='store', type='int', dest='ahead', default=PARTITIONS_AHEAD,
+                    help='Number of months after current month to create partitions for'),
+    )
+
+    def handle(self, **options):
+        partitioner = PhotoPartitioner(ahead=options['ahead'])
+        try:
+            if options['convert'] and partitioner.convert():
+                self.stdout.write('Converted table of photos into partitioned\n')
+            names = partitioner.create_partitions()
+        except ImproperlyConfigured as e:
+            raise CommandError(e)
+        self.stdout.write('Ensured %d partitions of table of photos\n' % len(names))
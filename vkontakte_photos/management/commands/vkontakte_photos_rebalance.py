@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from vkontakte_groups.models import Group
+from vkontakte_users.models import User
+
+from vkontakte_photos.models import OwnerShard, SHARD_MOVE_BATCH_SIZE
+from vkontakte_photos.routers import SHARD_DATABASES
+
+OWNER_MODELS = {'group': Group, 'user': User}
+
+
+class Command(BaseCommand):
+
+    help = 'Move owners with their albums and photos between shard databases. Can be interrupted and resumed'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--to', action='store', dest='to', help='Shard database to move owners into'),
+        make_option('--owner', action='append', dest='owners', default=[],
+                    help='Owner to move in format "group:ID" or "user:ID", can be repeated'),
+        make_option('--from', action='store', dest='from', help='Shard database to move owners from'),
+        make_option('--limit', action='store', type='int', dest='limit', default=None,
+                    help='Number of owners to move from shard database `--from`'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=SHARD_MOVE_BATCH_SIZE,
+                    help='Number of rows, copied in one transaction'),
+    )
+
+    def handle(self, **options):
+        if options['to'] not in SHARD_DATABASES:
+            raise CommandError('Option --to should be one of shard databases: %s' % ', '.join(SHARD_DATABASES))
+
+        owners = []
+        for owner in options['owners']:
+            try:
+                type_name, owner_id = owner.split(':')
+                owners += [(ContentType.objects.get_for_model(OWNER_MODELS[type_name]).pk, int(owner_id))]
+            except (KeyError, ValueError):
+                raise CommandError('Wrong format of owner "%s", should be "group:ID" or "user:ID"' % owner)
+        if options['from']:
+            owners += OwnerShard.objects.get_owners(options['from'], options['limit'])
+
+        for owner_content_type_id, owner_id in owners:
+            count = OwnerShard.objects.move(owner_content_type_id, owner_id, options['to'], options['batch_size'])
+            self.stdout.write('Moved %d albums and photos of owner %s:%s\n' % (count, owner_content_type_id, owner_id))
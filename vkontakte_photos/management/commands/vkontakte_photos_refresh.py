@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from vkontakte_photos.refresh import AlbumRefreshQueue, PhotoRefreshQueue, REFRESH_BATCH_SIZE
+
+
+class Command(BaseCommand):
+
+    help = ('Refresh the stalest albums or photos, which are due according to their change rate. '
+            'Many workers can be run at the same time without duplicate work')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--photos', action='store_true', dest='photos', default=False,
+                    help='Refresh photos instead of albums'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=REFRESH_BATCH_SIZE,
+                    help='Number of instances, claimed by worker at once'),
+        make_option('--batches', action='store', type='int', dest='batches', default=None,
+                    help='Stop after refreshing of this number of batches'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Run continuously, waiting for due instances'),
+        make_option('--budget', action='store', type='int', dest='budget', default=None,
+                    help='Maximum number of API calls during period'),
+        make_option('--period', action='store', type='int', dest='period', default=3600,
+                    help='Period of budget of API calls in seconds'),
+        make_option('--sleep', action='store', type='int', dest='sleep', default=60,
+                    help='Seconds of waiting for due instances in continuous mode'),
+    )
+
+    def handle(self, **options):
+        queue_class = PhotoRefreshQueue if options['photos'] else AlbumRefreshQueue
+        queue = queue_class(batch_size=options['batch_size'])
+        budget = options['budget']
+
+        period_started, spent = time.time(), 0
+        while True:
+            calls = queue.get_calls()
+            count = queue.run(batches=options['batches'], budget=budget - spent if budget else None)
+            spent += queue.get_calls() - calls
+            self.stdout.write('Refreshed %d instances of %s by %d API calls\n' % (
+                count, queue.model.__name__, queue.get_calls() - calls))
+
+            if not options['loop']:
+                break
+
+            if budget and spent >= budget:
+                # budget is spent, wait for the next period
+                time.sleep(max(0, period_started + options['period'] - time.time()))
+            else:
+                time.sleep(options['sleep'])
+
+            if time.time() - period_started >= options['period']:
+                period_started, spent = time.time(), 0
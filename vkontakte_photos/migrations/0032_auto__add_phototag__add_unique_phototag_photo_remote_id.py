@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'PhotoTag'
+        db.create_table(u'vkontakte_photos_phototag', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('photo', self.gf('django.db.models.fields.related.ForeignKey')(related_name='tags', to=orm['vkontakte_photos.Photo'])),
+            ('remote_id', self.gf('django.db.models.fields.BigIntegerField')()),
+            ('user', self.gf('django.db.models.fields.related.ForeignKey')(related_name='photos_tags', null=True, to=orm['vkontakte_users.User'])),
+            ('placer', self.gf('django.db.models.fields.related.ForeignKey')(related_name='photos_tags_placed', null=True, to=orm['vkontakte_users.User'])),
+            ('tagged_name', self.gf('django.db.models.fields.CharField')(max_length=200)),
+            ('date', self.gf('django.db.models.fields.DateTimeField')(null=True)),
+            ('x', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('y', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('x2', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('y2', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('viewed', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal(u'vkontakte_photos', ['PhotoTag'])
+
+        # Adding unique constraint on 'PhotoTag', fields ['photo', 'remote_id']
+        db.create_unique(u'vkontakte_photos_phototag', ['photo_id', 'remote_id'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'PhotoTag', fields ['photo', 'remote_id']
+        db.delete_unique(u'vkontakte_photos_phototag', ['photo_id', 'remote_id'])
+
+        # Deleting model 'PhotoTag'
+        db.delete_table(u'vkontakte_photos_phototag')
+
+
+    models = {
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'vkontakte_photos.album': {
+            'Meta': {'object_name': 'Album'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'fetched': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'fingerprint': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32'}),
+            'owner_content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'content_type_owners_vkontakte_photos_albums'", 'null': 'True', 'to': u"orm['contenttypes.ContentType']"}),
+            'owner_id': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'db_index': 'True'}),
+            'privacy': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'}),
+            'refresh_after': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'}),
+            'remote_id': ('django.db.models.fields.BigIntegerField', [], {'primary_key': 'True'}),
+            'size': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'thumb_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'thumb_src': ('django.db.models.fields.CharField', [], {'max_length': "'200'"}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': "'200'"}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'})
+        },
+        u'vkontakte_photos.photo': {
+            'Meta': {'object_name': 'Photo'},
+            'actions_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'album': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'photos'", 'to': u"orm['vkontakte_photos.Album']"}),
+            'archived': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'comments_count': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'fetched': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'fingerprint': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32'}),
+            'height': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'}),
+            'likes_count': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'db_index': 'True'}),
+            'likes_users': ('m2m_history.fields.ManyToManyHistoryField', [], {'related_name': "'like_photos'", 'symmetrical': 'False', 'to': u"orm['vkontakte_users.User']"}),
+            'owner_content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "u'content_type_owners_vkontakte_photos_photos'", 'null': 'True', 'to': u"orm['contenttypes.ContentType']"}),
+            'owner_id': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'db_index': 'True'}),
+            'photo_1280': ('django.db.models.fields.CharField', [], {'max_length': "'200'"}),
+            'photo_130': ('django.db.models.fields.CharField', [], {'max_length': "'200'"}),
+            'photo_2560': ('django.db.models.fields.CharField', [], {'max_length': "'200'"}),
+            'photo_604': ('django.db.models.fields.CharField', [], {'max_length': "'200'"}),
+            'photo_75': ('django.db.models.fields.CharField', [], {'max_length': "'200'"}),
+            'photo_807': ('django.db.models.fields.CharField', [], {'max_length': "'200'"}),
+            'refresh_after': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True'}),
+            'remote_id': ('django.db.models.fields.BigIntegerField', [], {'primary_key': 'True'}),
+            'tags_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'text': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'photos_author'", 'null': 'True', 'to': u"orm['vkontakte_users.User']"}),
+            'width': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'})
+        },
+        u'vkontakte_photos.phototag': {
+            'Meta': {'unique_together': "(('photo', 'remote_id'),)", 'object_name': 'PhotoTag'},
+            'date': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'photo': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'tags'", 'to': u"orm['vkontakte_photos.Photo']"}),
+            'placer': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'photos_tags_placed'", 'null': 'True', 'to': u"orm['vkontakte_users.User']"}),
+            'remote_id': ('django.db.models.fields.BigIntegerField', [], {}),
+            'tagged_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'photos_tags'", 'null': 'True', 'to': u"orm['vkontakte_users.User']"}),
+            'viewed': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'x': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'x2': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'y': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'y2': ('django.db.models.fields.FloatField', [], {'null': 'True'})
+        },
+        u'vkontakte_photos.refreshlock': {
+            'Meta': {'unique_together': "((u'content_type', u'object_id'),)", 'object_name': 'RefreshLock'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'locked': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'object_id': ('django.db.models.fields.BigIntegerField', [], {}),
+            'worker': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'vkontakte_places.city': {
+            'Meta': {'object_name': 'City'},
+            'area': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'country': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cities'", 'null': 'True', 'to': u"orm['vkontakte_places.Country']"}),
+            'fetched': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'region': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'remote_id': ('django.db.models.fields.BigIntegerField', [], {'unique': 'True'})
+        },
+        u'vkontakte_places.country': {
+            'Meta': {'object_name': 'Country'},
+            'fetched': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'remote_id': ('django.db.models.fields.BigIntegerField', [], {'unique': 'True'})
+        },
+        u'vkontakte_users.user': {
+            'Meta': {'object_name': 'User'},
+            'about': ('django.db.models.fields.TextField', [], {}),
+            'activity': ('django.db.models.fields.TextField', [], {}),
+            'albums': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'audios': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'bdate': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'books': ('django.db.models.fields.TextField', [], {}),
+            'city': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['vkontakte_places.City']", 'null': 'True', 'on_delete': 'models.SET_NULL'}),
+            'counters_updated': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'country': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['vkontakte_places.Country']", 'null': 'True', 'on_delete': 'models.SET_NULL'}),
+            'facebook': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'facebook_name': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'faculty': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'}),
+            'faculty_name': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'fetched': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'followers': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'friends': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'friends_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'friends_users': ('django.db.models.fields.related.ManyToManyField', [], {'related_name': "'followers_users'", 'symmetrical': 'False', 'to': u"orm['vkontakte_users.User']"}),
+            'games': ('django.db.models.fields.TextField', [], {}),
+            'graduation': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'}),
+            'has_avatar': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'db_index': 'True'}),
+            'has_mobile': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'}),
+            'home_phone': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'interests': ('django.db.models.fields.TextField', [], {}),
+            'is_deactivated': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'db_index': 'True'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'livejournal': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'mobile_phone': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'movies': ('django.db.models.fields.TextField', [], {}),
+            'mutual_friends': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'notes': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'photo': ('django.db.models.fields.URLField', [], {'max_length': '200'}),
+            'photo_big': ('django.db.models.fields.URLField', [], {'max_length': '200'}),
+            'photo_medium': ('django.db.models.fields.URLField', [], {'max_length': '200'}),
+            'photo_medium_rec': ('django.db.models.fields.URLField', [], {'max_length': '200'}),
+            'photo_rec': ('django.db.models.fields.URLField', [], {'max_length': '200'}),
+            'rate': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'}),
+            'relation': ('django.db.models.fields.SmallIntegerField', [], {'null': 'True'}),
+            'remote_id': ('django.db.models.fields.BigIntegerField', [], {'primary_key': 'True'}),
+            'screen_name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'sex': ('django.db.models.fields.IntegerField', [], {'null': 'True'}),
+            'skype': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'subscriptions': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'sum_counters': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'timezone': ('django.db.models.fields.IntegerField', [], {'null': 'True'}),
+            'tv': ('django.db.models.fields.TextField', [], {}),
+            'twitter': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'university': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'}),
+            'university_name': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'user_photos': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'user_videos': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'videos': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'wall_comments': ('django.db.models.fields.NullBooleanField', [], {'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['vkontakte_photos']
\ No newline at end of file
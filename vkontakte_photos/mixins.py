@@ -0,0 +1,670 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+from io import BytesIO
+import json
+import logging
+import random
+import socket
+import time
+
+import django
+import requests
+from django.conf import settings
+from django.db import connections, models, router
+from django.utils import timezone
+from django.utils.encoding import force_text
+from vkontakte_api.api import api_call, VkontakteError
+from vkontakte_api.decorators import atomic
+from vkontakte_api.models import VkontakteManager, VkontakteTimelineManager
+from vkontakte_api.signals import vkontakte_api_post_fetch
+from vkontakte_users.models import User
+
+from .exceptions import VkontakteCircuitOpenError
+from .ratelimit import TokenBucket, CircuitBreaker, Counters
+from .routers import get_current_database, get_object_shard, use_primary, use_shard
+
+log = logging.getLogger('vkontakte_photos')
+
+# Commit granularity of the fetch pipeline:
+#  * None - whole fetch (all pages) in a single transaction;
+#  * 'page' - separate transaction for every page of response;
+#  * integer N - separate transaction for every N saved rows.
+COMMIT_EVERY = getattr(settings, 'VKONTAKTE_PHOTOS_COMMIT_EVERY', None)
+
+# Limits of API calls
+API_RATE = getattr(settings, 'VKONTAKTE_PHOTOS_API_RATE', 3)  # calls per second
+API_MAX_RETRIES = getattr(settings, 'VKONTAKTE_PHOTOS_API_MAX_RETRIES', 5)
+API_BACKOFF = getattr(settings, 'VKONTAKTE_PHOTOS_API_BACKOFF', 1)  # seconds before the first retry
+CIRCUIT_FAILURES = getattr(settings, 'VKONTAKTE_PHOTOS_CIRCUIT_FAILURES', 5)
+CIRCUIT_PAUSE = getattr(settings, 'VKONTAKTE_PHOTOS_CIRCUIT_PAUSE', 300)  # seconds
+
+# Backfill of fetched instances by COPY on PostgreSQL and bulk_create on other backends
+BACKFILL_BATCH_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_BACKFILL_BATCH_SIZE', 1000)  # rows per bulk_create
+
+# save(update_fields=...) is supported since Django 1.5
+UPDATE_FIELDS_SUPPORTED = django.VERSION >= (1, 5)
+
+# Rate limit reached. Errors Too many requests per second (6), Flood control (9), Internal server error (10)
+# and HTTP errors 500, 501, 502, 504 are already retried with sleeping by api_call of vkontakte_api,
+# so they are neither retried again nor counted by circuit breaker
+RATE_LIMIT_ERROR_CODES = (29,)
+# Errors, counted by circuit breaker: rate limits, unknown errors and HTTP errors of API server,
+# not retried by api_call. Other errors, like access denied or deleted album, are specific to request
+# and don't pause calls for owner
+TRANSIENT_ERROR_CODES = RATE_LIMIT_ERROR_CODES + (1, 503)
+
+
+class CommitEveryManagerMixin(VkontakteTimelineManager):
+
+    """
+    Manager mixin, saving fetched instances in separate transactions according to argument `commit_every`
+    """
+    commit_every = COMMIT_EVERY
+    backfill = False
+    partition_field = None  # field of range partitioning of table
+
+    def get_commit_every(self, kwargs):
+        commit_every = kwargs.get('commit_every', self.commit_every)
+        if commit_every is not None and commit_every != 'page':
+            commit_every = int(commit_every)
+            if commit_every < 1:
+                raise ValueError("Attribute 'commit_every' should be 'page' or positive integer")
+        return commit_every
+
+    def get_or_create_from_instances(self, instances):
+        return [self.get_or_create_from_instance(instance) for instance in instances]
+
+    def save_instances(self, result, commit_every=None, after=None, before=None, backfill=False):
+        """
+        Save list of fetched instances with respect to timeline arguments `after` and `before`,
+        committing every `commit_every` instances, in bulk if `backfill`. Return list of PKs of saved instances
+        """
+        if self.timeline_force_ordering:
+            result.sort(key=self.get_timeline_date, reverse=True)
+
+        instances = []
+        for instance in result:
+            timeline_date = self.get_timeline_date(instance)
+
+            if timeline_date and isinstance(timeline_date, datetime):
+
+                if after and after > timeline_date:
+                    break
+
+                if before and before < timeline_date:
+                    continue
+
+            instances += [instance]
+
+        if not commit_every or commit_every == 'page':
+            # whole page in a single transaction
+            commit_every = max(len(instances), 1)
+
+        pks = []
+        for i in range(0, len(instances), commit_every):
+            with atomic(using=get_current_database()):
+                if backfill:
+                    pks += self.backfill_instances(instances[i:i + commit_every])
+                else:
+                    pks += [instance.pk for instance in
+                            self.get_or_create_from_instances(instances[i:i + commit_every])]
+            log.debug('Committed %d fetched instances of %s' % (len(pks), self.model.__name__))
+
+        return pks
+
+    def fetch(self, *args, **kwargs):
+        commit_every = self.get_commit_every(kwargs)
+        kwargs.pop('commit_every', None)
+        backfill = kwargs.pop('backfill', self.backfill)
+
+        after = kwargs.pop('after', None)
+        before = kwargs.pop('before', None)
+
+        result = self.get(*args, **kwargs)
+        if not isinstance(result, list):
+            with atomic(using=get_current_database()):
+                return self.get_or_create_from_instance(result)
+
+        pks = self.save_instances(result, commit_every, after, before, backfill)
+        return self.get_saved_queryset(pks, self.get_partition_bounds(result))
+
+    def get_written_objects(self, model=None):
+        """
+        Return default manager of `model` (model of manager by default), bound to database of writes,
+        to read instances saved by fetching without lag of replicas
+        """
+        model = model or self.model
+        return model.objects.db_manager(router.db_for_write(model))
+
+    def get_partition_bounds(self, instances):
+        """
+        Return minimal and maximal values of `partition_field` of `instances`
+        """
+        if not self.partition_field:
+            return []
+        values = [getattr(instance, self.partition_field) for instance in instances]
+        values = [value for value in values if value]
+        return [min(values), max(values)] if values else []
+
+    def get_saved_queryset(self, pks, bounds=()):
+        """
+        Return queryset of saved instances with `pks`. For table, partitioned by `partition_field`,
+        queryset is limited by `bounds` of values of this field to let database prune partitions
+        """
+        queryset = self.get_written_objects().filter(pk__in=pks)
+        if self.partition_field and bounds:
+            queryset = queryset.filter(**{'%s__range' % self.partition_field: (min(bounds), max(bounds))})
+        return queryset
+
+
+class BackfillManagerMixin(VkontakteManager):
+
+    """
+    Manager mixin for initial loading of large owners, saving fetched instances in bulk without signals.
+    On PostgreSQL 9.5+ rows are streamed by COPY into temporary staging table and merged into the table
+    by INSERT ... ON CONFLICT, stored values are kept for NULL values of fetched rows. Staging table is created
+    once per database session and emptied after every merge. On other backends
+    new instances are created by bulk_create in chunks of `backfill_batch_size`, existing ones are saved one by one.
+    Local state of stored rows `backfill_keep_fields`, missing in responses, is never overwritten by backfill
+    """
+    backfill_batch_size = BACKFILL_BATCH_SIZE
+    backfill_keep_fields = ('archived', 'refresh_after')
+    conflict_columns = {}
+
+    def backfill_instances(self, instances):
+        """
+        Save list of fetched instances in bulk. Return list of PKs of saved instances
+        """
+        if not instances:
+            return []
+
+        for instance in instances:
+            if hasattr(instance, 'get_fingerprint'):
+                instance.fingerprint = instance.get_fingerprint()
+
+        database = router.db_for_write(self.model, instance=instances[0])
+        connection = connections[database]
+        with atomic(using=database):
+            if self.is_copy_supported(connection):
+                self.copy_instances(instances, connection)
+            else:
+                self.bulk_create_instances(instances, database)
+
+        log.debug('Backfilled %d instances of %s' % (len(instances), self.model.__name__))
+        return [instance.pk for instance in instances]
+
+    def is_copy_supported(self, connection):
+        if connection.vendor != 'postgresql':
+            return False
+        connection.cursor()
+        # ON CONFLICT is supported since PostgreSQL 9.5
+        return getattr(connection, 'pg_version', 0) >= 90500
+
+    def get_copy_data(self, instances, fields, connection):
+        """
+        Return rows of instances in text format of COPY
+        """
+        def format_value(value):
+            if value is None:
+                return '\\N'
+            if isinstance(value, bool):
+                return 't' if value else 'f'
+            return force_text(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n') \
+                .replace('\r', '\\r')
+
+        lines = []
+        for instance in instances:
+            values = [field.get_db_prep_save(field.pre_save(instance, True), connection=connection) for field in fields]
+            lines += [u'\t'.join([format_value(value) for value in values])]
+        return u''.join([line + u'\n' for line in lines]).encode('utf-8')
+
+    def get_keep_fields(self):
+        return [field for field in self.model._meta.local_fields if field.name in self.backfill_keep_fields]
+
+    def get_conflict_columns(self, table, connection):
+        """
+        Return columns of primary key of table. Primary key of partitioned table includes column of partitioning.
+        Columns are cached for every database
+        """
+        key = (connection.alias, table)
+        if key not in self.conflict_columns:
+            cursor = connection.cursor()
+            cursor.execute("SELECT a.attname FROM pg_index i "
+                           "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+                           "WHERE i.indrelid = to_regclass(%s) AND i.indisprimary", [table])
+            self.conflict_columns[key] = [row[0] for row in cursor.fetchall()] or [self.model._meta.pk.column]
+        return self.conflict_columns[key]
+
+    def copy_instances(self, instances, connection):
+        qn = connection.ops.quote_name
+        fields = self.model._meta.local_fields
+        columns = ', '.join([qn(field.column) for field in fields])
+        table = self.model._meta.db_table
+        staging_table = qn('%s_backfill' % table)
+        conflict_columns = self.get_conflict_columns(table, connection)
+        keep_fields = self.get_keep_fields()
+
+        cursor = connection.cursor()
+        # temporary table lives until the end of session, so it's created only by the first call for connection
+        cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS %s (LIKE %s INCLUDING DEFAULTS) ON COMMIT DELETE ROWS'
+                       % (staging_table, qn(table)))
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (staging_table, columns),
+                           BytesIO(self.get_copy_data(instances, fields, connection)))
+        # DISTINCT ON skips duplicates of photos, shifted across page boundaries during fetching,
+        # the last copied duplicate is merged
+        cursor.execute('INSERT INTO %s (%s) SELECT DISTINCT ON (%s) %s FROM %s ORDER BY %s, ctid DESC '
+                       'ON CONFLICT (%s) DO UPDATE SET %s' % (
+                           qn(table), columns, ', '.join(map(qn, conflict_columns)), columns, staging_table,
+                           ', '.join(map(qn, conflict_columns)), ', '.join(map(qn, conflict_columns)),
+                           ', '.join(['%s = COALESCE(EXCLUDED.%s, %s.%s)' % (qn(field.column), qn(field.column),
+                                                                              qn(table), qn(field.column))
+                                      for field in fields
+                                      if field.column not in conflict_columns and field not in keep_fields])))
+        # rows are deleted on commit, but several pages can be merged inside one transaction
+        cursor.execute('DELETE FROM %s' % staging_table)
+
+    def bulk_create_instances(self, instances, database):
+        objects = self.model.objects.db_manager(database)
+        keep_fields = [field.attname for field in self.get_keep_fields()]
+        existed = dict([(row[0], row[1:]) for row in objects.filter(
+            pk__in=[instance.pk for instance in instances]).values_list('pk', *keep_fields)])
+
+        created = {}
+        for instance in instances:
+            if instance.pk not in existed:
+                created[instance.pk] = instance
+        created = list(created.values())
+        for i in range(0, len(created), self.backfill_batch_size):
+            objects.bulk_create(created[i:i + self.backfill_batch_size])
+
+        for instance in instances:
+            if instance.pk in existed:
+                for attname, value in zip(keep_fields, existed[instance.pk]):
+                    setattr(instance, attname, value)
+                self.get_or_create_from_instance(instance)
+
+
+class ShardManagerMixin(VkontakteManager):
+
+    """
+    Manager mixin, looking up stored instances in shard databases of their owners instead of master database
+    and substituting fetched instances with them in every database, so only changed fields are saved
+    """
+
+    def get_or_create_from_instance(self, instance):
+        database = router.db_for_write(self.model, instance=instance)
+        try:
+            old_instance = self.model.objects.using(database).get(pk=instance.pk) if instance.pk else None
+        except self.model.DoesNotExist:
+            old_instance = None
+        if old_instance:
+            instance._substitute(old_instance)
+        instance.save(using=database)
+
+        vkontakte_api_post_fetch.send(sender=instance.__class__, instance=instance, created=(not old_instance))
+        return instance
+
+
+class FingerprintManagerMixin(VkontakteManager):
+
+    """
+    Manager mixin, skipping UPDATE of fetched instances with the same fingerprint as stored one.
+    Field `fetched` of skipped instances is updated by a single statement together with counters `counter_fields`,
+    if they differ from stored ones, by one statement for all instances with the same values of counters
+    """
+
+    def get_or_create_from_instances(self, instances):
+        databases = {}
+        for instance in instances:
+            databases.setdefault(router.db_for_write(self.model, instance=instance), []).append(instance)
+
+        result = []
+        for database, instances in databases.items():
+            result += self.get_or_create_from_database_instances(database, instances)
+        return result
+
+    def get_or_create_from_database_instances(self, database, instances):
+        objects = self.model.objects.db_manager(database)
+        counter_fields = list(self.model.counter_fields)
+        stored = objects.in_bulk([instance.pk for instance in instances if instance.pk])
+
+        unchanged = {}
+        skipped = []
+        result = []
+        for instance in instances:
+            old_instance = stored.get(instance.pk)
+            if old_instance and old_instance.fingerprint == instance.get_fingerprint():
+                counters = tuple([getattr(instance, field_name) for field_name in counter_fields])
+                stored_counters = tuple([getattr(old_instance, field_name) for field_name in counter_fields])
+                unchanged.setdefault(counters if counters != stored_counters else None, []).append(instance.pk)
+                skipped += [instance]
+            else:
+                # substitute parsed instance with stored one, so only changed fields are saved
+                if old_instance:
+                    instance._substitute(old_instance)
+                instance.save(using=database)
+                vkontakte_api_post_fetch.send(sender=instance.__class__, instance=instance,
+                                              created=(not old_instance))
+            result += [instance]
+
+        fetched = timezone.now()
+        for counters, pks in unchanged.items():
+            objects.filter(pk__in=pks).update(fetched=fetched, **dict(zip(counter_fields, counters or ())))
+
+        for instance in skipped:
+            vkontakte_api_post_fetch.send(sender=instance.__class__, instance=instance, created=False)
+        if skipped:
+            log.debug('Skipped saving of %d unchanged instances of %s' % (len(skipped), self.model.__name__))
+
+        return result
+
+
+class FingerprintModelMixin(models.Model):
+
+    """
+    Model mixin, storing compact fingerprint of synced fields `fingerprint_fields`. Counters `counter_fields`
+    are changed by raw UPDATEs without recalculation of fingerprint, so they are not included into it
+    and compared with stored values directly
+    """
+    fingerprint_fields = ()
+    counter_fields = ()
+
+    fingerprint = models.CharField(max_length=32, default='', editable=False)
+
+    class Meta:
+        abstract = True
+
+    def get_fingerprint(self):
+        values = [force_text(getattr(self, field_name, None)) for field_name in self.fingerprint_fields]
+        return hashlib.md5(u'\n'.join(values).encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = self.get_fingerprint()
+        super(FingerprintModelMixin, self).save(*args, **kwargs)
+
+
+class UpdateFieldsModelMixin(models.Model):
+
+    """
+    Model mixin, tracking fields changed since loading of instance from database or since substitution
+    of parsed instance with stored one, and saving only them. Concurrent updates of other fields,
+    for example counters, are not overwritten by stale values. Instances are saved entirely on Django 1.4
+    """
+
+    class Meta:
+        abstract = True
+
+    def __init__(self, *args, **kwargs):
+        super(UpdateFieldsModelMixin, self).__init__(*args, **kwargs)
+        self._stored_values = self.get_field_values()
+
+    def get_field_values(self):
+        # deferred fields are not loaded into __dict__, they are saved only after loading
+        return dict([(field.attname, self.__dict__[field.attname]) for field in self._meta.fields
+                     if not field.primary_key and field.attname in self.__dict__])
+
+    def get_changed_fields(self):
+        """
+        Return list of names of fields, changed since loading, or None if instance should be saved entirely
+        """
+        if not UPDATE_FIELDS_SUPPORTED or self._state.adding or not self.pk:
+            return None
+        values = self.get_field_values()
+        return [field.name for field in self._meta.fields if field.attname in values
+                and (field.attname not in self._stored_values
+                     or values[field.attname] != self._stored_values[field.attname])]
+
+    def _substitute(self, old_instance):
+        super(UpdateFieldsModelMixin, self)._substitute(old_instance)
+        self._stored_values = old_instance._stored_values
+        self._state.adding = False
+        self._state.db = old_instance._state.db
+
+    def save(self, *args, **kwargs):
+        if not args and 'update_fields' not in kwargs and not kwargs.get('force_insert'):
+            changed_fields = self.get_changed_fields()
+            if changed_fields is not None:
+                kwargs['update_fields'] = changed_fields
+        super(UpdateFieldsModelMixin, self).save(*args, **kwargs)
+        self._stored_values = self.get_field_values()
+
+
+class ReconcileManagerMixin(VkontakteManager):
+
+    """
+    Manager mixin for detection of instances, removed from VK, by comparing full set of fetched ids
+    with stored ones inside of database. Fetching with any of arguments `filtering_kwargs` returns
+    only part of instances, so it can't be reconciled
+    """
+    ids_table_name = 'vkontakte_photos_reconcile_ids'
+    ids_insert_chunk_size = 500
+    filtering_kwargs = ('ids', 'after', 'before', 'offset')
+
+    def is_filtered(self, kwargs):
+        return any([kwargs.get(name) for name in self.filtering_kwargs])
+
+    def check_unfiltered(self, kwargs):
+        if self.is_filtered(kwargs):
+            raise ValueError("Arguments %s are not allowed for synchronization of all instances" % ', '.join(
+                [name for name in self.filtering_kwargs if kwargs.get(name)]))
+
+    @contextmanager
+    def ids_table(self, ids, connection):
+        """
+        Context manager, returning SQL subquery and params, selecting `ids`: compact array on PostgreSQL,
+        temporary table on other databases
+        """
+        ids = list(ids)
+        if connection.vendor == 'postgresql':
+            yield 'SELECT unnest(%s::bigint[])', [ids]
+            return
+
+        table = connection.ops.quote_name(self.ids_table_name)
+        cursor = connection.cursor()
+        cursor.execute('CREATE TEMPORARY TABLE %s (id BIGINT PRIMARY KEY)' % table)
+        try:
+            for i in range(0, len(ids), self.ids_insert_chunk_size):
+                cursor.executemany('INSERT INTO %s (id) VALUES (%%s)' % table,
+                                   [(id,) for id in ids[i:i + self.ids_insert_chunk_size]])
+            yield 'SELECT id FROM %s' % table, []
+        finally:
+            cursor.execute('DROP TABLE %s' % table)
+
+    def reconcile(self, queryset, ids):
+        """
+        Mark instances of `queryset`, missing in `ids`, as archived and instances with `ids` as not archived
+        by two set-based UPDATEs. Return tuple of numbers of archived and restored instances
+        """
+        connection = connections[queryset.db]
+        pk = '%s.%s' % (connection.ops.quote_name(self.model._meta.db_table),
+                        connection.ops.quote_name(self.model._meta.pk.column))
+        with self.ids_table(ids, connection) as (sql, params):
+            archived = queryset.filter(archived=False).extra(where=['%s NOT IN (%s)' % (pk, sql)], params=params) \
+                .update(archived=True)
+            restored = queryset.filter(archived=True).extra(where=['%s IN (%s)' % (pk, sql)], params=params) \
+                .update(archived=False)
+
+        log.debug('Archived %d and restored %d instances of %s' % (archived, restored, self.model.__name__))
+        return archived, restored
+
+
+class RefreshScheduleModelMixin(models.Model):
+
+    """
+    Model mixin, storing time of the next refresh of instance, scheduled by refresh queue according to age
+    of the last change `refresh_date_field` and growth rate of counter `refresh_counter_field`
+    """
+    refresh_date_field = None
+    refresh_counter_field = None
+
+    refresh_after = models.DateTimeField(null=True, db_index=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+
+class LikesSyncModelMixin(models.Model):
+
+    """
+    Model mixin for synchronization of field `likes_users` with history of likes page by page: new likes are
+    inserted and removed likes are closed by setting `time_to` in bulk, missing users are created as stubs
+    """
+    likes_page_size = 1000  # maximum `count` of likes.getList
+    sql_chunk_size = 500  # maximum number of ids in one `IN` clause
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def get_likes_relation(cls):
+        through = cls.likes_users.through
+        field_name = [field.name for field in through._meta.local_fields
+                      if field.name not in ['id', 'user', 'time_from', 'time_to']][0]
+        return through, field_name
+
+    def iter_likes_user_ids(self):
+        offset = 0
+        while True:
+            ids = User.remote.fetch_likes_user_ids(likes_type=self.likes_remote_type, owner_id=self.owner_remote_id,
+                                                   item_id=self.remote_id_short, offset=offset,
+                                                   count=self.likes_page_size)
+            if ids:
+                yield ids
+            if len(ids) < self.likes_page_size:
+                break
+            offset += len(ids)
+
+    @classmethod
+    def create_users_stubs(cls, ids):
+        """
+        Create missing users with `ids` as stubs in bulk, checking existence by chunks of ids
+        """
+        ids = list(ids)
+        existed = set()
+        for i in range(0, len(ids), cls.sql_chunk_size):
+            existed.update(User.objects.filter(pk__in=ids[i:i + cls.sql_chunk_size]).values_list('pk', flat=True))
+        User.objects.bulk_create([User(remote_id=id) for id in ids if id not in existed])
+
+    @use_primary()
+    def sync_likes(self):
+        """
+        Fetch ids of all users, who like the instance, and synchronize them with stored likes.
+        Return number of current likes
+        """
+        with use_shard(get_object_shard(self)):
+            return self.sync_likes_shard()
+
+    def sync_likes_shard(self):
+        through, field_name = self.get_likes_relation()
+        now = timezone.now()
+
+        current = set(through.objects.filter(**{field_name: self, 'time_to__isnull': True})
+                      .values_list('user_id', flat=True))
+        fetched = set()
+        for ids in self.iter_likes_user_ids():
+            ids = [id for id in set(ids) if id not in fetched]
+            fetched.update(ids)
+            entered = [id for id in ids if id not in current]
+            with atomic(using=get_current_database()):
+                self.create_users_stubs(entered)
+                through.objects.bulk_create([through(user_id=id, time_from=now, **{field_name: self})
+                                             for id in entered])
+            log.debug('Inserted %d new likes of %s %s' % (len(entered), self._meta.module_name, self.pk))
+
+        left = list(current.difference(fetched))
+        with atomic(using=get_current_database()):
+            for i in range(0, len(left), self.sql_chunk_size):
+                through.objects.filter(**{field_name: self, 'time_to__isnull': True,
+                                          'user_id__in': left[i:i + self.sql_chunk_size]}).update(time_to=now)
+        log.debug('Closed %d removed likes of %s %s' % (len(left), self._meta.module_name, self.pk))
+
+        self.likes_count = len(fetched)
+        if hasattr(self, 'update_counters'):
+            self.update_counters('likes_count', {self.pk: self.likes_count})
+        else:
+            self.__class__.objects.filter(pk=self.pk).update(likes_count=self.likes_count)
+        return self.likes_count
+
+
+class RateLimitManagerMixin(VkontakteManager):
+
+    """
+    Manager mixin, limiting rate of API calls by token bucket, retrying calls failed with rate limit errors
+    with exponential backoff and jitter and pausing calls for owner after repeated failures.
+    Limiter, circuit breaker and counters are shared by all managers of application
+    """
+    limiter = TokenBucket(API_RATE)
+    breaker = CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_PAUSE)
+    counters = Counters()
+    max_retries = API_MAX_RETRIES
+    backoff = API_BACKOFF
+
+    def call_with_limits(self, func, owner_id, *args, **kwargs):
+        if owner_id and self.breaker.is_open(owner_id):
+            self.counters.increment('rejected')
+            raise VkontakteCircuitOpenError("API calls for owner %s are paused after repeated failures" % owner_id)
+
+        attempt = 0
+        while True:
+            if self.limiter.wait():
+                self.counters.increment('throttled')
+            self.counters.increment('calls')
+
+            try:
+                response = func(*args, **kwargs)
+            except (VkontakteError, requests.RequestException, socket.error) as e:
+                # network errors have no code
+                code = getattr(e, 'code', None) if isinstance(e, VkontakteError) else None
+                if code in RATE_LIMIT_ERROR_CODES and attempt < self.max_retries:
+                    delay = self.backoff * 2 ** attempt
+                    delay += random.uniform(0, delay)
+                    self.counters.increment('retries')
+                    log.warning('Rate limit error %s, retry in %.1f sec, attempt %d' % (code, delay, attempt + 1))
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+
+                if code is not None and code not in TRANSIENT_ERROR_CODES:
+                    raise
+
+                self.counters.increment('failures')
+                if owner_id and self.breaker.failure(owner_id):
+                    self.counters.increment('circuits_opened')
+                    log.error('API calls for owner %s are paused for %d sec after repeated failures' % (
+                        owner_id, self.breaker.pause))
+                raise
+
+            if owner_id:
+                self.breaker.success(owner_id)
+            return response
+
+    def api_call(self, *args, **kwargs):
+        return self.call_with_limits(super(RateLimitManagerMixin, self).api_call, kwargs.get('owner_id'),
+                                     *args, **kwargs)
+
+
+class ExecuteManagerMixin(RateLimitManagerMixin):
+
+    """
+    Manager mixin for packing many calls of API method into `execute` requests
+    """
+    execute_limit = 25  # maximum number of API calls inside one `execute` request
+
+    def execute(self, method, params_list):
+        """
+        Call `method` of manager's namespace with every dict of parameters from `params_list`,
+        packing up to `execute_limit` calls into one `execute` request.
+        Return list of responses in the same order, failed calls have `False` as response
+        """
+        method = self.methods.get(method, method)
+        responses = []
+        for i in range(0, len(params_list), self.execute_limit):
+            calls = ['API.%s.%s(%s)' % (self.methods_namespace, method, json.dumps(params))
+                     for params in params_list[i:i + self.execute_limit]]
+            response = self.call_with_limits(api_call, None, 'execute', code='return [%s];' % ','.join(calls),
+                                             v=float(self.version))
+            log.debug('Executed %d calls of method %s.%s' % (len(calls), self.methods_namespace, method))
+            responses += response
+        return responses
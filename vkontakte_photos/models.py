@@ -1,22 +1,41 @@
 # -*- coding: utf-8 -*-
 from django.contrib.contenttypes import generic
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models, transaction
+from django.db import connection, connections, models, router
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
+from datetime import datetime, timedelta
+import calendar
 import logging
+from multiprocessing.dummy import Pool as ThreadPool
 from parser import VkontaktePhotosParser
 import re
 import requests
 
-from vkontakte_api.decorators import fetch_all
+from vkontakte_api.api import api_call
+from vkontakte_api.decorators import fetch_all, atomic
 from vkontakte_api.mixins import CountOffsetManagerMixin, AfterBeforeManagerMixin, OwnerableModelMixin, LikableModelMixin
 from vkontakte_api.models import VkontakteTimelineManager, VkontakteModel, VkontakteCRUDModel, VkontaktePKModel
 from vkontakte_comments.mixins import CommentableModelMixin
+from vkontakte_comments.models import Comment
 
 from vkontakte_users.models import User
+
+from .decorators import atomic_fetch, owner_shard, split_by_shards
+from .mixins import (BackfillManagerMixin, CommitEveryManagerMixin, ExecuteManagerMixin, FingerprintManagerMixin,
+                     FingerprintModelMixin, LikesSyncModelMixin, ReconcileManagerMixin, RefreshScheduleModelMixin,
+                     ShardManagerMixin, UpdateFieldsModelMixin)
+from .routers import (PRIMARY_DATABASE, clear_shards_cache, get_current_database, get_object_shard, get_shard,
+                      use_primary, use_shard)
+
 log = logging.getLogger('vkontakte_photos')
 
+ARCHIVE_AFTER_DAYS = getattr(settings, 'VKONTAKTE_PHOTOS_ARCHIVE_AFTER_DAYS', 30)
+ARCHIVE_BATCH_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_ARCHIVE_BATCH_SIZE', 500)
+SHARD_MOVE_BATCH_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_SHARD_MOVE_BATCH_SIZE', 500)
+
 ALBUM_PRIVACY_CHOCIES = (
     (0, u'Все пользователи'),
     (1, u'Только друзья'),
@@ -25,7 +44,8 @@ ALBUM_PRIVACY_CHOCIES = (
 )
 
 
-class AlbumRemoteManager(AfterBeforeManagerMixin):
+class AlbumRemoteManager(AfterBeforeManagerMixin, ExecuteManagerMixin, ReconcileManagerMixin, ShardManagerMixin,
+                         FingerprintManagerMixin, BackfillManagerMixin, CommitEveryManagerMixin):
 
     methods_namespace = 'photos'
     version = 5.27
@@ -35,12 +55,20 @@ class AlbumRemoteManager(AfterBeforeManagerMixin):
 #        'edit': 'editAlbum',
     }
     timeline_force_ordering = True
+    filtering_kwargs = ('ids', 'album_ids', 'after', 'before', 'offset')
 
     def get_timeline_date(self, instance):
         return instance.updated or instance.created or timezone.now()
 
-    @transaction.commit_on_success
-    def fetch(self, user=None, group=None, owner=None, ids=None, need_covers=False, **kwargs):
+    def parse_response_list(self, response_list, extra_fields=None):
+        # system albums have negative ids, which are not unique among owners, so it's impossible to store them
+        instances = super(AlbumRemoteManager, self).parse_response_list(response_list, extra_fields)
+        return [instance for instance in instances if instance.remote_id > 0]
+
+    @owner_shard
+    @atomic_fetch
+    def fetch(self, user=None, group=None, owner=None, ids=None, need_covers=False, need_system=False, count=None,
+              offset=0, **kwargs):
         if not (user or group):
             #raise ValueError("You must specify user of group, which albums you want to fetch")
             if not owner:
@@ -58,13 +86,141 @@ class AlbumRemoteManager(AfterBeforeManagerMixin):
         # 1 - будет возвращено дополнительное поле thumb_src. По умолчанию поле thumb_src не возвращается.
         kwargs['need_covers'] = int(need_covers)
 
+        # need_system
+        # 1 - будут возвращены системные альбомы, имеющие отрицательные идентификаторы.
+        kwargs['need_system'] = int(need_system)
+
         # aids
         # перечисленные через запятую ID альбомов.
         if ids:
             kwargs.update({'album_ids': ','.join(map(str, ids))})
 
+        if count:
+            return self.fetch_pages(count=count, offset=offset, **kwargs)
+
         return super(AlbumRemoteManager, self).fetch(**kwargs)
 
+    def fetch_pages(self, count, offset=0, after=None, before=None, **kwargs):
+        """
+        Fetch albums page by page using `offset` and `count` parameters of photos.getAlbums.
+        Every page is saved right after receiving, so only one page is kept in memory
+        """
+        if before and not after:
+            raise ValueError("Attribute `before` should be specified with attribute `after`")
+        if before and before < after:
+            raise ValueError("Attribute `before` should be later, than attribute `after`")
+
+        commit_every = self.get_commit_every(kwargs)
+        kwargs.pop('commit_every', None)
+        backfill = kwargs.pop('backfill', self.backfill)
+        count = int(count)
+        offset = int(offset)
+
+        pks = []
+        while True:
+            response = self.api_call(count=count, offset=offset, **kwargs)
+            instances = self.parse_response_list(response, {'fetched': timezone.now()})
+            pks += self.save_instances(instances, commit_every, after, before, backfill)
+
+            log.debug('Fetched page of %d albums with offset %d' % (len(response), offset))
+
+            if len(response) < count:
+                break
+            offset += len(response)
+
+        return self.get_written_objects().filter(pk__in=pks)
+
+    @split_by_shards
+    @use_primary()
+    def fetch_for_owners(self, owners, need_covers=False, **kwargs):
+        """
+        Fetch albums of many owners, packing photos.getAlbums calls for `execute_limit` owners into one request.
+        Albums of every request are saved in a separate transaction. Stored albums of owners, missing
+        in responses, are archived with their photos, if fetching is not filtered.
+        Return list of fetched albums of all owners
+        """
+        owners = list(owners)
+        kwargs['need_covers'] = int(need_covers)
+        owners_failed = []
+        remote_ids = set()
+
+        fetched = timezone.now()
+        for i in range(0, len(owners), self.execute_limit):
+            owners_chunk = owners[i:i + self.execute_limit]
+            responses = self.execute('get', [dict(kwargs, owner_id=self.model.get_owner_remote_id(owner))
+                                             for owner in owners_chunk])
+            instances = []
+            for owner, response in zip(owners_chunk, responses):
+                if not response:
+                    log.warning('Impossible to fetch albums of owner "%s", response: %s' % (owner, response))
+                    owners_failed += [owner]
+                    continue
+                for resource in response['items']:
+                    resource.pop('owner_id', None)
+                instances += self.parse_response_list(response['items'], {'fetched': timezone.now(), 'owner': owner})
+
+            with atomic(using=get_current_database()):
+                self.get_or_create_from_instances(instances)
+            remote_ids.update([instance.pk for instance in instances])
+
+        # arguments are sent to API as is, so `count` limits number of albums of owner
+        if not self.is_filtered(kwargs) and not kwargs.get('count'):
+            self.reconcile_owners([owner for owner in owners if owner not in owners_failed], remote_ids)
+        return self.get_written_objects().filter(self.get_owners_q(owners), fetched__gte=fetched)
+
+    def get_owners_q(self, owners):
+        owners_ids = {}
+        for owner in owners:
+            owners_ids.setdefault(ContentType.objects.get_for_model(owner), []).append(owner.pk)
+
+        owners_q = Q()
+        for owner_content_type, owner_ids in owners_ids.items():
+            owners_q |= Q(owner_content_type=owner_content_type, owner_id__in=owner_ids)
+        return owners_q
+
+    def reconcile_owners(self, owners, remote_ids):
+        """
+        Archive stored albums of `owners`, missing in `remote_ids` (deleted or made private), and all photos
+        of them. Albums, which appeared again, are restored, their photos are restored by the next sync of them.
+        Return tuple of numbers of archived and restored albums
+        """
+        if not owners:
+            return 0, 0
+        with atomic(using=get_current_database()):
+            albums = self.model.objects.filter(self.get_owners_q(owners))
+            archived, restored = self.reconcile(albums, remote_ids)
+            if archived:
+                photos = Photo.objects.filter(album__in=albums.filter(archived=True), archived=False) \
+                    .update(archived=True)
+                log.debug('Archived %d photos of %d missing albums' % (photos, archived))
+        return archived, restored
+
+    @owner_shard
+    @use_primary()
+    def sync(self, owner, **kwargs):
+        """
+        Fetch all albums of owner, archive missing albums with their photos and restore albums,
+        which appeared again. Return tuple of numbers of fetched, archived and restored albums
+        """
+        self.check_unfiltered(kwargs)
+        remote_ids = list(self.fetch(owner=owner, **kwargs).values_list('pk', flat=True))
+        archived, restored = self.reconcile_owners([owner], remote_ids)
+        return len(remote_ids), archived, restored
+
+    @owner_shard
+    def create_missing(self, owner, ids):
+        """
+        Create empty albums of owner with `ids`, which don't exist in DB yet, by one INSERT.
+        Fields of albums will be filled by the next Album.remote.fetch()
+        """
+        ids = set(ids).difference(self.model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        if ids:
+            owner_content_type = ContentType.objects.get_for_model(owner)
+            self.model.objects.bulk_create([self.model(remote_id=id, owner_content_type=owner_content_type,
+                                                       owner_id=owner.pk, thumb_id=0, size=0) for id in ids])
+            log.debug('Created %d missing albums of owner "%s"' % (len(ids), owner))
+        return ids
+
     def get_upload_url(self, album):
         kwargs = {}
         kwargs['album_id'] = album.remote_id
@@ -76,21 +232,26 @@ class AlbumRemoteManager(AfterBeforeManagerMixin):
         return response['upload_url']
 
 
-class PhotoRemoteManager(CountOffsetManagerMixin, AfterBeforeManagerMixin):
+class PhotoRemoteManager(CountOffsetManagerMixin, AfterBeforeManagerMixin, ExecuteManagerMixin, ReconcileManagerMixin,
+                         ShardManagerMixin, FingerprintManagerMixin, BackfillManagerMixin, CommitEveryManagerMixin):
 
     methods_namespace = 'photos'
     version = 5.27
     #remote_pk = ('remote_id',)
-    methods = {'get': 'get', 'delete': 'delete', }
+    methods = {'get': 'get', 'get_all': 'getAll', 'get_all_comments': 'getAllComments', 'get_tags': 'getTags',
+               'delete': 'delete', }
     timeline_cut_fieldname = 'date'
     timeline_force_ordering = True
+    partition_field = 'date'
+    filtering_kwargs = ('ids', 'photo_ids', 'after', 'before', 'offset')
+    execute_response_limit = 1000  # maximum number of photos in response of one `execute` request
+    newsfeed_sources_limit = 100  # maximum number of owners in `source_ids` of one newsfeed.get request
 
-    @transaction.commit_on_success
-    def fetch(self, album, ids=None, extended=False, photo_sizes=False, rev=0, **kwargs):
+    def get_fetch_params(self, album, ids=None, extended=False, photo_sizes=False, rev=0, **kwargs):
         if ids and not isinstance(ids, (tuple, list)):
             raise ValueError("Attribute 'ids' should be tuple or list")
         # TODO: it seems rev attribute make no sence for order of response
-        if rev == 1 and (after or before):
+        if rev == 1 and (kwargs.get('after') or kwargs.get('before')):
             raise ValueError("Attribute `rev` should be equal to 0 with defined `after` attribute")
 
         kwargs.update({
@@ -116,11 +277,458 @@ class PhotoRemoteManager(CountOffsetManagerMixin, AfterBeforeManagerMixin):
         # feed_type
         # Тип новости получаемый в поле type метода newsfeed.get, для получения только загруженных пользователем фотографий, либо только фотографий, на которых он был отмечен. Может принимать значения photo, photo_tag.
 
+        return kwargs
+
+    @owner_shard
+    @atomic_fetch
+    def fetch(self, album, workers=None, **kwargs):
+        if workers:
+            # parallel fetching always fetches all photos of album, so it's not paged by `fetch_all` again
+            if kwargs.get('all'):
+                raise ValueError("Attribute 'all' can not be used with attribute 'workers'")
+            return self.fetch_parallel(album, workers=workers, **kwargs)
+        return self.fetch_sequential(album, **kwargs)
+
+    @fetch_all(default_count=100)
+    def fetch_sequential(self, album, **kwargs):
+        kwargs = self.get_fetch_params(album, **kwargs)
         return super(PhotoRemoteManager, self).fetch(**kwargs)
 
+    def fetch_parallel(self, album, workers, count=100, offset=0, after=None, before=None, **kwargs):
+        """
+        Fetch all photos of album, requesting pages with offsets, known from stored `Album.size`,
+        concurrently by pool of `workers` threads. Threads only make API calls, responses are parsed
+        and saved in the calling thread in order of offsets. Photos, shifted across page boundaries
+        during fetching, are saved once. Photos, added after the last known offset, are fetched sequentially
+        """
+        count = int(count)
+        if count > 100:
+            raise ValueError("Attribute 'count' can not be more than 100")
+        offset = int(offset)
+
+        commit_every = self.get_commit_every(kwargs)
+        kwargs.pop('commit_every', None)
+        backfill = kwargs.pop('backfill', self.backfill)
+        kwargs = self.get_fetch_params(album, **kwargs)
+
+        def get_page(offset):
+            try:
+                return self.api_call(count=count, offset=offset, **kwargs)
+            finally:
+                # close DB connection, opened by thread while getting access token
+                connection.close()
+
+        pks = []
+        remote_ids = set()
+        bounds = []
+
+        def save_page(response, offset):
+            resources = [resource for resource in response if resource['id'] not in remote_ids]
+            remote_ids.update([resource['id'] for resource in resources])
+
+            instances = self.parse_response_list(resources, {'fetched': timezone.now()})
+            pks.extend(self.save_instances(instances, commit_every, after, before, backfill))
+            bounds.extend(self.get_partition_bounds(instances))
+            log.debug('Fetched page of %d photos of album %s with offset %d' % (len(response), album, offset))
+
+        offsets = range(offset, max(album.size, offset + 1), count)
+        pool = ThreadPool(int(workers))
+        try:
+            for i, response in enumerate(pool.imap(get_page, offsets)):
+                save_page(response, offsets[i])
+        finally:
+            pool.terminate()
+
+        # album has been grown since the last fetching of it
+        offset = offsets[-1]
+        while len(response) == count:
+            offset += count
+            response = self.api_call(count=count, offset=offset, **kwargs)
+            save_page(response, offset)
+
+        return self.get_saved_queryset(pks, bounds)
+
+    def iter_fetch(self, album, count=100, offset=0, as_counts=False, **kwargs):
+        """
+        Generator, fetching photos of album page by page and saving every page in a separate transaction
+        or every `commit_every` photos. Photos are filtered by timeline arguments `after` and `before` as in `fetch`.
+        Yields list of saved photos of each page or amount of them if `as_counts` is True.
+        Only one page is kept in memory, so it's suitable for albums of any size.
+        Usage:
+
+            for photos in Photo.remote.iter_fetch(album=album):
+                ...
+        """
+        count = int(count)
+        if count > 100:
+            raise ValueError("Attribute 'count' can not be more than 100")
+        offset = int(offset)
+
+        commit_every = self.get_commit_every(kwargs)
+        kwargs.pop('commit_every', None)
+        backfill = kwargs.pop('backfill', self.backfill)
+        kwargs = self.get_fetch_params(album, **kwargs)
+        after = kwargs.pop('after', None)
+        before = kwargs.pop('before', None)
+        shard = get_object_shard(album)
+
+        while True:
+            instances = self.get(count=count, offset=offset, **kwargs)
+            with use_shard(shard):
+                pks = set(self.save_instances(list(instances), commit_every, after, before, backfill))
+            photos = [instance for instance in instances if instance.pk in pks]
+
+            log.debug('Fetched page of %d photos of album %s with offset %d' % (len(photos), album, offset))
+            yield len(photos) if as_counts else photos
+
+            if len(instances) < count:
+                break
+            offset += len(instances)
+
+    def get_execute_packs(self, albums):
+        """
+        Split small albums into packs for `execute` requests with respect to
+        maximum number of calls and maximum number of photos in response
+        """
+        pack, pack_size = [], 0
+        for album in albums:
+            if pack and (len(pack) == self.execute_limit or pack_size + album.size > self.execute_response_limit):
+                yield pack
+                pack, pack_size = [], 0
+            pack += [album]
+            pack_size += album.size
+        if pack:
+            yield pack
+
+    @split_by_shards
+    @use_primary()
+    def fetch_for_albums(self, albums, **kwargs):
+        """
+        Fetch photos of many albums. Albums with stored `size` not more than one page are fetched
+        by photos.get calls packed into `execute` requests, other albums are fetched page by page.
+        Stored photos of completely fetched albums, missing in response, are archived, if fetching is not filtered.
+        Return list of fetched photos of all albums
+        """
+        albums = list(albums)
+        albums_small = [album for album in albums if album.size <= 100]
+        albums_big = [album for album in albums if album.size > 100]
+        albums_failed = []
+        remote_ids = set()
+
+        fetched = timezone.now()
+        for pack in self.get_execute_packs(albums_small):
+            responses = self.execute('get', [dict(self.get_fetch_params(album, **kwargs), count=100) for album in pack])
+            instances = []
+            for album, response in zip(pack, responses):
+                if not response:
+                    log.warning('Impossible to fetch photos of album %s, response: %s' % (album.remote_id, response))
+                    albums_failed += [album]
+                    continue
+                for resource in response['items']:
+                    resource.pop('owner_id', None)
+                instances += self.parse_response_list(response['items'], {'fetched': timezone.now(), 'owner': album.owner})
+
+                if response['count'] > len(response['items']):
+                    # stored size of album is outdated
+                    albums_big += [album]
+
+            with atomic(using=get_current_database()):
+                self.get_or_create_from_instances(instances)
+            remote_ids.update([instance.pk for instance in instances])
+
+        for album in albums_big:
+            for photos in self.iter_fetch(album, **kwargs):
+                remote_ids.update([photo.pk for photo in photos])
+
+        if not self.is_filtered(kwargs):
+            self.reconcile(self.model.objects.filter(album__in=[album for album in albums
+                                                                if album not in albums_failed]), remote_ids)
+
+        return self.get_written_objects().filter(album__in=albums, fetched__gte=fetched)
+
+    @owner_shard
+    @use_primary()
+    def sync(self, album, **kwargs):
+        """
+        Fetch all photos of album page by page, archive stored photos, missing in album,
+        and restore archived photos, which appeared again. Return tuple of numbers of fetched,
+        archived and restored photos
+        """
+        self.check_unfiltered(kwargs)
+        remote_ids = set()
+        for photos in self.iter_fetch(album, **kwargs):
+            remote_ids.update([photo.pk for photo in photos])
+
+        archived, restored = self.reconcile(self.model.objects.filter(album=album), remote_ids)
+        return len(remote_ids), archived, restored
+
+    @split_by_shards
+    @use_primary()
+    def discover(self, owners, start_time=None, **kwargs):
+        """
+        Discover new photos of many owners by newsfeed.get with filter `photo`, packing
+        `newsfeed_sources_limit` owners into one request, and fetch photos only of albums with new photos.
+        Return list of fetched photos
+        """
+        owners = dict([(self.model.get_owner_remote_id(owner), owner) for owner in owners])
+        owners_remote_ids = owners.keys()
+
+        albums_ids = {}
+        for i in range(0, len(owners_remote_ids), self.newsfeed_sources_limit):
+            params = {
+                'filters': 'photo',
+                'source_ids': ','.join(map(str, owners_remote_ids[i:i + self.newsfeed_sources_limit])),
+                'count': 100,
+                'v': float(self.version),
+            }
+            if start_time:
+                params['start_time'] = calendar.timegm(start_time.utctimetuple())
+
+            while True:
+                response = self.call_with_limits(api_call, None, 'newsfeed.get', **params)
+                for item in response['items']:
+                    for photo in item.get('photos', {}).get('items', []):
+                        if photo['owner_id'] in owners and photo.get('album_id', 0) > 0:
+                            albums_ids.setdefault(photo['owner_id'], set()).add(photo['album_id'])
+
+                if not response.get('next_from'):
+                    break
+                params['start_from'] = response['next_from']
+
+        for owner_remote_id, ids in albums_ids.items():
+            Album.remote.create_missing(owners[owner_remote_id], ids)
+        albums = Album.objects.filter(pk__in=set().union(*albums_ids.values()))
+
+        log.debug('Discovered new photos in %d albums of %d owners' % (albums.count(), len(albums_ids)))
+        return self.fetch_for_albums(albums, **kwargs)
+
+    @owner_shard
+    @use_primary()
+    def fetch_all_for_owner(self, owner, extended=False, photo_sizes=False, count=200, offset=0, **kwargs):
+        """
+        Fetch all photos of owner from all albums using photos.getAll with pages of maximum size.
+        Missing albums are created in bulk before saving every page, photos are saved in bulk if `backfill`.
+        Photos of service albums (wall, profile, saved) are not fetched, because their album ids are negative
+        and not unique among owners, so it's impossible to store them as Album instances.
+        Return queryset of fetched photos of owner
+        """
+        count = int(count)
+        if count > 200:
+            raise ValueError("Attribute 'count' can not be more than 200")
+        offset = int(offset)
+        backfill = kwargs.pop('backfill', self.backfill)
+
+        kwargs.update({
+            'owner_id': self.model.get_owner_remote_id(owner),
+            'extended': int(extended),
+            'photo_sizes': int(photo_sizes),
+            # no_service_albums
+            # 0 — вернуть все фотографии, включая находящиеся в сервисных альбомах, таких как "Фотографии на моей стене" (по умолчанию)
+            # 1 — вернуть фотографии только из стандартных альбомов пользователя или сообщества
+            'no_service_albums': 1,
+        })
+
+        fetched = timezone.now()
+        while True:
+            instances = self.get(method='get_all', count=count, offset=offset, **kwargs)
+            photos = [instance for instance in instances if instance.album_id > 0]
+            with atomic(using=get_current_database()):
+                Album.remote.create_missing(owner, set([photo.album_id for photo in photos]))
+                if backfill:
+                    self.backfill_instances(photos)
+                else:
+                    self.get_or_create_from_instances(photos)
+
+            log.debug('Fetched page of %d photos of owner "%s" with offset %d' % (len(photos), owner, offset))
+
+            if len(instances) < count:
+                break
+            offset += len(instances)
+
+        return self.get_written_objects().filter(owner_content_type=ContentType.objects.get_for_model(owner),
+                                                 owner_id=owner.pk, fetched__gte=fetched)
+
+    def save_comments(self, items, photos, fetched):
+        """
+        Save comments of photos in bulk: new comments are inserted, changed comments are updated,
+        for unchanged comments only field `fetched` is updated by one statement.
+        Missing users, authors of comments, are created as stubs in bulk before parsing of comments
+        """
+        self.model.create_users_stubs(set([item['from_id'] for item in items if item['from_id'] > 0]))
+        comments = []
+        for item in items:
+            photo = photos[item['pid']]
+            comment = Comment(object=photo, owner=photo.owner, fetched=fetched)
+            item = dict(item)
+            item.pop('pid')
+            comment.parse(item)
+            comments += [comment]
+
+        stored = dict([(values[0], values[1:]) for values in Comment.objects.filter(
+            remote_id__in=[comment.remote_id for comment in comments]).values_list(
+            'remote_id', 'pk', 'text', 'likes_count', 'archived')])
+
+        unchanged = []
+        for comment in comments:
+            if comment.remote_id in stored:
+                comment.pk, text, likes_count, archived = stored[comment.remote_id]
+                if (text, likes_count, archived) == (comment.text, comment.likes_count, False):
+                    unchanged += [comment.pk]
+                else:
+                    comment.save()
+
+        Comment.objects.filter(pk__in=unchanged).update(fetched=fetched)
+        Comment.objects.bulk_create([comment for comment in comments if comment.remote_id not in stored])
+
+    def update_comments_counts(self, photos):
+        """
+        Update `comments_count` and `actions_count` of `photos` by stored comments, one statement per chunk.
+        If comments are stored in another database than photos, counters are updated by counts of comments
+        """
+        content_type_id = ContentType.objects.get_for_model(self.model).pk
+        database = router.db_for_write(self.model)
+        if router.db_for_write(Comment) != database:
+            return self.update_comments_counts_separately(photos, content_type_id)
+
+        connection = connections[database]
+        qn = connection.ops.quote_name
+        comments_count = '''(SELECT COUNT(*) FROM %(comment)s WHERE %(comment)s.%(object_content_type_id)s = %%s
+            AND %(comment)s.%(object_id)s = %(photo)s.%(pk)s AND %(comment)s.%(archived)s = %%s)'''
+        values = {
+            'photo': qn(self.model._meta.db_table),
+            'comment': qn(Comment._meta.db_table),
+            'pk': qn(self.model._meta.pk.column),
+            'object_content_type_id': qn('object_content_type_id'),
+            'object_id': qn('object_id'),
+            'archived': qn('archived'),
+        }
+        values['comments_count'] = comments_count % values
+
+        # ids are selected before UPDATE, because MySQL doesn't allow subquery from the updated table
+        ids = list(photos.values_list('pk', flat=True))
+        cursor = connection.cursor()
+        for i in range(0, len(ids), self.model.counters_chunk_size):
+            chunk = ids[i:i + self.model.counters_chunk_size]
+            values['ids'] = ', '.join(['%s'] * len(chunk))
+            cursor.execute('''UPDATE %(photo)s SET comments_count = %(comments_count)s,
+                actions_count = COALESCE(likes_count, 0) + %(comments_count)s
+                WHERE %(pk)s IN (%(ids)s)''' % values, [content_type_id, False] * 2 + chunk)
+
+    def update_comments_counts_separately(self, photos, content_type_id):
+        ids = list(photos.values_list('pk', flat=True))
+        for i in range(0, len(ids), self.model.counters_chunk_size):
+            chunk = ids[i:i + self.model.counters_chunk_size]
+            counts = dict(Comment.objects.filter(object_content_type_id=content_type_id, object_id__in=chunk,
+                                                 archived=False)
+                          .values_list('object_id').annotate(count=models.Count('pk')).order_by())
+            self.model.update_counters('comments_count', dict([(id, counts.get(id, 0)) for id in chunk]))
+
+    @owner_shard
+    @use_primary()
+    def fetch_all_comments(self, owner=None, album=None, need_likes=False, count=100, offset=0, **kwargs):
+        """
+        Fetch comments of all photos of `album` or of all albums of `owner` using photos.getAllComments
+        page by page instead of calls for every photo. Comments of unknown photos are skipped.
+        Counters of comments of photos are updated by stored comments.
+        Return queryset of fetched comments
+        """
+        if not (owner or album):
+            raise ValueError("You must specify owner or album, which comments you want to fetch")
+        count = int(count)
+        if count > 100:
+            raise ValueError("Attribute 'count' can not be more than 100")
+        offset = int(offset)
+
+        if album:
+            owner = album.owner
+            kwargs['album_id'] = album.remote_id
+            photos = self.model.objects.filter(album=album)
+        else:
+            photos = self.model.objects.filter(owner_content_type=ContentType.objects.get_for_model(owner),
+                                               owner_id=owner.pk)
+
+        kwargs.update({
+            'owner_id': self.model.get_owner_remote_id(owner),
+            'need_likes': int(need_likes),
+        })
+
+        fetched = timezone.now()
+        while True:
+            items = self.api_call(method='get_all_comments', count=count, offset=offset, **kwargs)
+            known = photos.in_bulk(set([item['pid'] for item in items]))
+            with atomic(using=router.db_for_write(Comment)):
+                self.save_comments([item for item in items if item['pid'] in known], known, fetched)
+
+            log.debug('Fetched page of %d comments of photos of owner "%s" with offset %d' % (len(items), owner, offset))
+
+            if len(items) < count:
+                break
+            offset += len(items)
+
+        with atomic(using=get_current_database()):
+            self.update_comments_counts(photos)
+
+        content_type = ContentType.objects.get_for_model(self.model)
+        if router.db_for_write(Comment) != router.db_for_write(self.model):
+            photos = list(photos.values_list('pk', flat=True))
+        return self.get_written_objects(Comment).filter(object_content_type=content_type, object_id__in=photos,
+                                                        fetched__gte=fetched)
+
+    @split_by_shards
+    @use_primary()
+    def fetch_tags(self, photos):
+        """
+        Fetch tags of many photos by photos.getTags calls packed into `execute` requests.
+        Tags and `tags_count` of photos of every request are replaced in bulk.
+        Return list of tags of photos
+        """
+        photos = list(photos)
+        for i in range(0, len(photos), self.execute_limit):
+            pack = photos[i:i + self.execute_limit]
+            responses = self.execute('get_tags', [{'owner_id': photo.owner_remote_id, 'photo_id': photo.remote_id}
+                                                  for photo in pack])
+            tags = []
+            counts = {}
+            for photo, response in zip(pack, responses):
+                if response is False:
+                    log.warning('Impossible to fetch tags of photo %s' % photo.remote_id)
+                    continue
+                counts.setdefault(len(response), []).append(photo.pk)
+                tags += [PhotoTag(photo=photo).parse(resource) for resource in response]
+
+            with atomic(using=get_current_database()):
+                self.model.create_users_stubs(set([tag.user_id for tag in tags if tag.user_id] +
+                                                  [tag.placer_id for tag in tags if tag.placer_id]))
+                PhotoTag.objects.filter(photo__in=[pk for ids in counts.values() for pk in ids]).delete()
+                PhotoTag.objects.bulk_create(tags)
+                for count, ids in counts.items():
+                    self.model.objects.filter(pk__in=ids).update(tags_count=count)
+
+            log.debug('Fetched %d tags of %d photos' % (len(tags), len(pack)))
+
+        return self.get_written_objects(PhotoTag).filter(photo__in=photos)
+
+
+class OwnerManager(models.Manager):
+
+    """
+    Default manager of albums and photos, querying instances of owner in shard database of owner
+    """
+
+    def for_owner(self, owner):
+        return self.db_manager(get_object_shard(owner)).filter(
+            owner_content_type=ContentType.objects.get_for_model(owner), owner_id=owner.pk)
+
 
 @python_2_unicode_compatible
-class Album(OwnerableModelMixin, VkontaktePKModel):
+class Album(FingerprintModelMixin, UpdateFieldsModelMixin, RefreshScheduleModelMixin, OwnerableModelMixin,
+            VkontaktePKModel):
+
+    fingerprint_fields = ('owner_id', 'thumb_id', 'thumb_src', 'title', 'description', 'created', 'updated',
+                          'size', 'privacy')
+    refresh_date_field = 'updated'
+    refresh_counter_field = 'size'
+
     thumb_id = models.PositiveIntegerField()
     thumb_src = models.CharField(u'Обложка альбома', max_length='200')
 
@@ -133,7 +741,9 @@ class Album(OwnerableModelMixin, VkontaktePKModel):
     size = models.PositiveIntegerField(u'Кол-во фотографий')
     privacy = models.PositiveIntegerField(u'Уровень доступа к альбому', null=True, choices=ALBUM_PRIVACY_CHOCIES)
 
-    objects = models.Manager()
+    archived = models.BooleanField(u'В архиве', default=False)
+
+    objects = OwnerManager()
     remote = AlbumRemoteManager()
 
     class Meta:
@@ -147,10 +757,12 @@ class Album(OwnerableModelMixin, VkontaktePKModel):
     def slug(self):
         return 'album%s_%s' % (self.owner_remote_id, self.remote_id)
 
-    @transaction.commit_on_success
     def fetch_photos(self, *args, **kwargs):
         return Photo.remote.fetch(album=self, *args, **kwargs)
 
+    def fetch_comments(self, *args, **kwargs):
+        return Photo.remote.fetch_all_comments(album=self, *args, **kwargs)
+
     def get_upload_url(self):
         if not (hasattr(self, 'upload_url') and self.upload_url):
             manager = AlbumRemoteManager()
@@ -161,6 +773,7 @@ class Album(OwnerableModelMixin, VkontaktePKModel):
 
         return self.upload_url
 
+    @use_primary()
     def upload_photos(self, files, caption=''):
         if len(files) == 0:
             raise Exception("No files to upload")
@@ -207,14 +820,24 @@ class Album(OwnerableModelMixin, VkontaktePKModel):
             return photos
 
 
-class Photo(OwnerableModelMixin, LikableModelMixin, CommentableModelMixin, VkontaktePKModel, VkontakteCRUDModel):
+class PhotoBase(FingerprintModelMixin, UpdateFieldsModelMixin, RefreshScheduleModelMixin, LikesSyncModelMixin,
+                OwnerableModelMixin, LikableModelMixin, CommentableModelMixin, VkontaktePKModel, VkontakteCRUDModel):
+
+    """
+    Fields and methods of photo, shared by live table of photos and archive table
+    """
 
     comments_remote_related_name = 'photo_id'
     likes_remote_type = 'photo'
     _commit_remote = False
+    fingerprint_fields = ('album_id', 'owner_id', 'user_id', 'text', 'photo_75', 'photo_130', 'photo_604',
+                          'photo_807', 'photo_1280', 'photo_2560', 'width', 'height', 'date')
+    counter_fields = ('likes_count', 'comments_count', 'actions_count', 'tags_count')
+    refresh_date_field = 'date'
+    refresh_counter_field = 'actions_count'
 
-    album = models.ForeignKey(Album, verbose_name=u'Альбом', related_name='photos')
-    user = models.ForeignKey(User, verbose_name=u'Автор фотографии', null=True, related_name='photos_author')
+    album = models.ForeignKey(Album, verbose_name=u'Альбом', related_name='%(class)ss')
+    user = models.ForeignKey(User, verbose_name=u'Автор фотографии', null=True, related_name='%(class)ss_author')
 
     #src = models.CharField(u'Иконка', max_length='200')
     #src_big = models.CharField(u'Большая', max_length='200')
@@ -239,12 +862,35 @@ class Photo(OwnerableModelMixin, LikableModelMixin, CommentableModelMixin, Vkont
 
     date = models.DateTimeField(db_index=True)
 
-    objects = models.Manager()
-    remote = PhotoRemoteManager()
+    counters_chunk_size = 500
 
     class Meta:
-        verbose_name = u'Фотография Вконтакте'
-        verbose_name_plural = u'Фотографии Вконтакте'
+        abstract = True
+
+    @classmethod
+    def update_counters(cls, field_name, counts, using=None):
+        """
+        Set counter `field_name` (likes_count or comments_count) of photos from dict `counts` of values by pk
+        and recalculate `actions_count` from stored value of another counter by targeted UPDATEs,
+        one for all photos with the same value, so concurrent refreshes of another counter are not lost
+        """
+        other_field_name = {'likes_count': 'comments_count', 'comments_count': 'likes_count'}[field_name]
+        database = using or router.db_for_write(cls)
+        connection = connections[database]
+        qn = connection.ops.quote_name
+        pks_by_values = {}
+        for pk, value in counts.items():
+            pks_by_values.setdefault(value, []).append(pk)
+
+        # raw cursor is not committed by Django < 1.6 outside of transaction
+        with atomic(using=database):
+            cursor = connection.cursor()
+            for value, pks in pks_by_values.items():
+                for i in range(0, len(pks), cls.counters_chunk_size):
+                    chunk = pks[i:i + cls.counters_chunk_size]
+                    cursor.execute('UPDATE %s SET %s = %%s, %s = COALESCE(%s, 0) + %%s WHERE %s IN (%s)' % (
+                        qn(cls._meta.db_table), qn(field_name), qn('actions_count'), qn(other_field_name),
+                        qn(cls._meta.pk.column), ', '.join(['%s'] * len(chunk))), [value, value] + chunk)
 
     @property
     def src(self):
@@ -259,7 +905,7 @@ class Photo(OwnerableModelMixin, LikableModelMixin, CommentableModelMixin, Vkont
         return 'photo%s_%s' % (self.owner_remote_id, self.remote_id)
 
     def parse(self, response):
-        super(Photo, self).parse(response)
+        super(PhotoBase, self).parse(response)
 
         # counters
         for field_name in ['tags']:  # ['likes', 'comments', 'tags']:
@@ -297,7 +943,7 @@ class Photo(OwnerableModelMixin, LikableModelMixin, CommentableModelMixin, Vkont
         parser = VkontaktePhotosParser().request('/al_photos.php', data=post_data)
 
         self.comments_count = len(parser.content_bs.findAll('div', {'class': 'clear_fix pv_comment '}))
-        self.save()
+        self.update_counters('comments_count', {self.pk: self.comments_count}, using=self._state.db)
 
     def fetch_likes_parser(self):
         '''
@@ -315,7 +961,7 @@ class Photo(OwnerableModelMixin, LikableModelMixin, CommentableModelMixin, Vkont
         values = re.findall(r'value="(\d+)"', parser.html)
         if len(values):
             self.likes_count = int(values[0])
-            self.save()
+            self.update_counters('likes_count', {self.pk: self.likes_count}, using=self._state.db)
 
     def prepare_delete_params(self):
         return {
@@ -323,3 +969,282 @@ class Photo(OwnerableModelMixin, LikableModelMixin, CommentableModelMixin, Vkont
             'photo_id': self.remote_id,
             #'methods_namespace': get_methods_namespace(self),
         }
+
+
+class Photo(PhotoBase):
+
+    objects = OwnerManager()
+    remote = PhotoRemoteManager()
+
+    class Meta:
+        verbose_name = u'Фотография Вконтакте'
+        verbose_name_plural = u'Фотографии Вконтакте'
+
+
+class PhotoArchiveManager(models.Manager):
+
+    """
+    Manager of archive of photos, moving archived photos from the live table
+    """
+
+    def get_archivable(self, before=None):
+        before = before or timezone.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+        return Photo.objects.filter(archived=True, fetched__lt=before)
+
+    def move(self, before=None, batch_size=ARCHIVE_BATCH_SIZE):
+        """
+        Move archived photos, fetched last time before `before`, with history of their likes into archive table
+        batch by batch, every batch in a separate transaction, so it can be interrupted and resumed at any moment.
+        Comments are attached to archived photos, tags are removed. Return number of moved photos
+        """
+        count = 0
+        while True:
+            ids = list(self.get_archivable(before).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            self.move_batch(ids)
+            count += len(ids)
+            log.debug('Moved %d photos into archive' % count)
+        return count
+
+    def move_batch(self, ids):
+        database = get_current_database()
+        with atomic(using=database):
+            self.move_batch_rows(ids, connections[database])
+
+    def move_batch_rows(self, ids, connection):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+
+        def where(column):
+            return 'WHERE %s IN (%s)' % (qn(column), ', '.join(['%s'] * len(ids)))
+
+        def copy(source, target, source_columns, target_columns, column):
+            cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s ' % (
+                qn(target), ', '.join(map(qn, target_columns)), ', '.join(map(qn, source_columns)), qn(source))
+                + where(column), ids)
+
+        def delete(table, column):
+            # raw DELETE, because ORM deletes generic related comments also
+            cursor.execute('DELETE FROM %s ' % qn(table) + where(column), ids)
+
+        photos_table, archive_table = Photo._meta.db_table, self.model._meta.db_table
+        likes_table, archive_likes_table = [model.likes_users.through._meta.db_table for model in [Photo, self.model]]
+        pk_column = Photo._meta.pk.column
+
+        # previous copies of photos, which were archived, appeared again and archived again
+        delete(archive_likes_table, 'photoarchive_id')
+        delete(archive_table, pk_column)
+
+        columns = [field.column for field in Photo._meta.local_fields]
+        copy(photos_table, archive_table, columns, columns, pk_column)
+        likes_columns = ['user_id', 'time_from', 'time_to']
+        copy(likes_table, archive_likes_table, ['photo_id'] + likes_columns, ['photoarchive_id'] + likes_columns,
+             'photo_id')
+
+        Comment.objects.filter(object_content_type=ContentType.objects.get_for_model(Photo), object_id__in=ids) \
+            .update(object_content_type=ContentType.objects.get_for_model(self.model))
+        PhotoTag.objects.filter(photo__in=ids).delete()
+        delete(likes_table, 'photo_id')
+        delete(photos_table, pk_column)
+
+
+class PhotoArchive(PhotoBase):
+
+    """
+    Archive of photos, removed from VK long time ago, with the same schema as Photo
+    """
+    objects = PhotoArchiveManager()
+
+    class Meta:
+        verbose_name = u'Архивная фотография Вконтакте'
+        verbose_name_plural = u'Архивные фотографии Вконтакте'
+
+
+class PhotoTag(models.Model):
+
+    """
+    Tag of user on photo
+    """
+    photo = models.ForeignKey(Photo, verbose_name=u'Фотография', related_name='tags')
+    remote_id = models.BigIntegerField(u'ID')
+
+    user = models.ForeignKey(User, verbose_name=u'Отмеченный пользователь', null=True, related_name='photos_tags')
+    placer = models.ForeignKey(User, verbose_name=u'Автор отметки', null=True, related_name='photos_tags_placed')
+    tagged_name = models.CharField(u'Название отметки', max_length=200)
+    date = models.DateTimeField(null=True)
+
+    x = models.FloatField(null=True)
+    y = models.FloatField(null=True)
+    x2 = models.FloatField(null=True)
+    y2 = models.FloatField(null=True)
+
+    viewed = models.BooleanField(default=False)
+
+    class Meta:
+        verbose_name = u'Отметка на фотографии Вконтакте'
+        verbose_name_plural = u'Отметки на фотографиях Вконтакте'
+        unique_together = (('photo', 'remote_id'),)
+
+    def parse(self, response):
+        self.remote_id = response['id']
+        self.user_id = response.get('user_id') or None
+        self.placer_id = response.get('placer_id') or None
+        self.tagged_name = response.get('tagged_name', '')
+        if response.get('date'):
+            self.date = datetime.utcfromtimestamp(response['date']).replace(tzinfo=timezone.utc)
+        for field_name in ['x', 'y', 'x2', 'y2']:
+            if field_name in response:
+                setattr(self, field_name, float(response[field_name]))
+        self.viewed = bool(response.get('viewed'))
+        return self
+
+
+class RefreshLock(models.Model):
+
+    """
+    Instance, claimed by worker of refresh queue on databases without support of SKIP LOCKED
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.BigIntegerField()
+
+    worker = models.CharField(max_length=100)
+    locked = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+
+class CallbackEvent(models.Model):
+
+    """
+    Event of VK Callback API, stored before answering to VK and waiting for processing in batch
+    """
+    type = models.CharField(max_length=50)
+    data = models.TextField()
+
+    received = models.DateTimeField(db_index=True)
+
+
+class OwnerShardManager(models.Manager):
+
+    """
+    Manager of placements of owners in shard databases, moving owners between shards
+    """
+
+    def get_owners(self, database, limit=None):
+        """
+        Return list of tuples of content type id and id of owners with albums in shard `database`
+        """
+        owners = Album.objects.using(database).values_list('owner_content_type', 'owner_id').distinct() \
+            .order_by('owner_content_type', 'owner_id')
+        return list(owners[:limit] if limit else owners)
+
+    def move(self, owner_content_type_id, owner_id, database, batch_size=SHARD_MOVE_BATCH_SIZE):
+        """
+        Move albums and photos of owner with history of their likes and tags into shard `database` batch by batch,
+        every batch in a separate transaction, so moving can be interrupted and resumed at any moment.
+        Placement of owner is switched after copying of all rows, rows are deleted from the source shard after that.
+        Rows, saved into the source shard during moving by workers with outdated placement, are fetched again
+        by the next refresh of owner. Return number of moved albums and photos
+        """
+        source = get_shard(owner_content_type_id, owner_id)
+        if source == database:
+            return 0
+
+        owner = {'owner_content_type_id': owner_content_type_id, 'owner_id': owner_id}
+        count = self.copy(Album.objects.using(source).filter(**owner), database, batch_size)
+        for model in [Photo, PhotoArchive]:
+            count += self.copy(model.objects.using(source).filter(**owner), database, batch_size,
+                               self.get_photos_relations(model))
+
+        with atomic(using=PRIMARY_DATABASE):
+            if not self.using(PRIMARY_DATABASE).filter(**owner).update(database=database):
+                self.using(PRIMARY_DATABASE).create(database=database, **owner)
+        clear_shards_cache()
+
+        for model in [Photo, PhotoArchive]:
+            self.delete(model.objects.using(source).filter(**owner), batch_size, self.get_photos_relations(model))
+        self.delete(Album.objects.using(source).filter(**owner), batch_size)
+
+        log.debug('Moved %d albums and photos of owner %s:%s from %s to %s' % (count, owner_content_type_id,
+                                                                                owner_id, source, database))
+        return count
+
+    def get_photos_relations(self, model):
+        """
+        Return list of models and names of fields of rows, related to photos of `model` by foreign key
+        """
+        relations = [model.get_likes_relation()]
+        if model == Photo:
+            relations += [(PhotoTag, 'photo')]
+        return relations
+
+    def copy(self, queryset, database, batch_size, relations=()):
+        """
+        Copy rows of `queryset` into `database`, skipping already copied ones. Related rows
+        with autoincrement keys are copied without keys, replacing related rows of copied rows
+        """
+        model = queryset.model
+        count = 0
+        last_pk = None
+        while True:
+            batch = queryset.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            instances = list(batch[:batch_size])
+            if not instances:
+                break
+            last_pk = instances[-1].pk
+            pks = [instance.pk for instance in instances]
+
+            with atomic(using=database):
+                existed = set(model.objects.using(database).filter(pk__in=pks).values_list('pk', flat=True))
+                model.objects.using(database).bulk_create([instance for instance in instances
+                                                           if instance.pk not in existed])
+                for related_model, field_name in relations:
+                    lookup = {'%s__in' % field_name: pks}
+                    related = list(related_model.objects.using(queryset.db).filter(**lookup))
+                    for instance in related:
+                        instance.pk = None
+                    related_model.objects.using(database).filter(**lookup).delete()
+                    related_model.objects.using(database).bulk_create(related)
+            count += len(instances) - len(existed)
+        return count
+
+    def delete(self, queryset, batch_size, relations=()):
+        """
+        Delete rows of `queryset` with related rows by raw DELETEs, because ORM deletes generic related comments also
+        """
+        connection = connections[queryset.db]
+        qn = connection.ops.quote_name
+        while True:
+            pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            def delete_rows(model, column):
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                    qn(model._meta.db_table), qn(column), ', '.join(['%s'] * len(pks))), pks)
+
+            with atomic(using=queryset.db):
+                cursor = connection.cursor()
+                for related_model, field_name in relations:
+                    delete_rows(related_model, related_model._meta.get_field(field_name).column)
+                delete_rows(queryset.model, queryset.model._meta.pk.column)
+
+
+class OwnerShard(models.Model):
+
+    """
+    Shard database of owner of albums and photos, placed by rebalancing instead of shard by hash of owner
+    """
+    owner_content_type = models.ForeignKey(ContentType)
+    owner_id = models.BigIntegerField()
+
+    database = models.CharField(max_length=100)
+
+    objects = OwnerShardManager()
+
+    class Meta:
+        unique_together = (('owner_content_type', 'owner_id'),)
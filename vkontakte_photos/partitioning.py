@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from datetime import date
+import logging
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils import timezone
+from vkontakte_api.decorators import atomic
+
+from .models import Photo
+
+log = logging.getLogger('vkontakte_photos')
+
+PARTITIONS_AHEAD = getattr(settings, 'VKONTAKTE_PHOTOS_PARTITIONS_AHEAD', 3)  # months
+
+
+def get_next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def get_months(since, until):
+    """
+    Return list of first days of months from month of `since` till month of `until` inclusively
+    """
+    month = date(since.year, since.month, 1)
+    months = []
+    while (month.year, month.month) <= (until.year, until.month):
+        months += [month]
+        month = get_next_month(month)
+    return months
+
+
+class TablePartitioner(object):
+
+    """
+    Helper of declarative range partitioning of table of `model` by monthly partitions of `field`
+    on PostgreSQL 11+. Primary key and unique constraints of partitioned table include `field`,
+    so foreign keys, referencing table, are dropped by conversion
+    """
+    model = None
+    field = None
+
+    def __init__(self, ahead=PARTITIONS_AHEAD):
+        self.ahead = ahead
+        self.qn = connection.ops.quote_name
+        self.table = self.model._meta.db_table
+        self.column = self.model._meta.get_field(self.field).column
+
+    def check_connection(self):
+        if connection.vendor != 'postgresql':
+            raise ImproperlyConfigured("Partitioning of table %s is supported only by PostgreSQL" % self.table)
+        connection.cursor()
+        if getattr(connection, 'pg_version', 0) < 110000:
+            raise ImproperlyConfigured("Partitioning of table %s requires PostgreSQL 11 or later" % self.table)
+
+    def execute(self, sql, params=None):
+        cursor = connection.cursor()
+        cursor.execute(sql, params or [])
+        return cursor
+
+    def get_partition_name(self, month):
+        return '%s_y%04dm%02d' % (self.table, month.year, month.month)
+
+    def is_partitioned(self):
+        self.check_connection()
+        row = self.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [self.table]).fetchone()
+        return bool(row) and row[0] == 'p'
+
+    def create_partitions(self, since=None):
+        """
+        Create monthly partitions from month of `since` (now by default) till `ahead` months after now.
+        Already existing partitions are skipped. Return list of names of partitions
+        """
+        if not self.is_partitioned():
+            raise ImproperlyConfigured("Table %s is not partitioned, convert it by command "
+                                       "vkontakte_photos_partitions with option --convert" % self.table)
+
+        now = timezone.now()
+        until = now.date().replace(day=1)
+        for i in range(self.ahead):
+            until = get_next_month(until)
+
+        names = []
+        for month in get_months(since or now, until):
+            name = self.get_partition_name(month)
+            self.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%%s) TO (%%s)" % (
+                self.qn(name), self.qn(self.table)), [month, get_next_month(month)])
+            names += [name]
+        log.debug('Ensured %d partitions of table %s' % (len(names), self.table))
+        return names
+
+    def drop_referencing_constraints(self):
+        cursor = self.execute("SELECT conrelid::regclass::text, conname FROM pg_constraint "
+                              "WHERE contype = 'f' AND confrelid = to_regclass(%s)", [self.table])
+        for table, name in cursor.fetchall():
+            self.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (table, self.qn(name)))
+            log.debug('Dropped foreign key %s of table %s, referencing table %s' % (name, table, self.table))
+
+    def get_constraints(self, table):
+        """
+        Return list of types and columns of primary key and unique constraints of `table`, primary key first
+        """
+        cursor = self.execute("SELECT c.contype, array_agg(a.attname ORDER BY k.i) FROM pg_constraint c "
+                              "CROSS JOIN LATERAL unnest(c.conkey) WITH ORDINALITY AS k(attnum, i) "
+                              "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum "
+                              "WHERE c.conrelid = to_regclass(%s) AND c.contype IN ('p', 'u') "
+                              "GROUP BY c.oid, c.contype ORDER BY c.contype", [table])
+        return cursor.fetchall()
+
+    def get_indexes(self, table):
+        cursor = self.execute("SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+                              "WHERE i.indrelid = to_regclass(%s) AND NOT i.indisprimary AND NOT i.indisunique",
+                              [table])
+        return cursor.fetchall()
+
+    @atomic
+    def convert(self):
+        """
+        Convert existing table into partitioned one, moving all rows into monthly partitions.
+        Table is locked during conversion. Return False if table is already partitioned
+        """
+        if self.is_partitioned():
+            return False
+
+        old_table = '%s_unpartitioned' % self.table
+        self.drop_referencing_constraints()
+        self.execute("ALTER TABLE %s RENAME TO %s" % (self.qn(self.table), self.qn(old_table)))
+        self.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (%s)" % (
+            self.qn(self.table), self.qn(old_table), self.qn(self.column)))
+
+        for contype, columns in self.get_constraints(old_table):
+            if self.column not in columns:
+                columns += [self.column]
+            self.execute("ALTER TABLE %s ADD %s (%s)" % (
+                self.qn(self.table), 'PRIMARY KEY' if contype == 'p' else 'UNIQUE',
+                ', '.join([self.qn(column) for column in columns])))
+
+        for name, definition in self.get_indexes(old_table):
+            # index is dropped to free its name for the same index of the new table
+            self.execute("DROP INDEX %s" % name)
+            self.execute(re.sub(r' ON (\S+\.)?"?%s"? ' % re.escape(old_table), ' ON %s ' % self.qn(self.table),
+                                definition))
+
+        since = self.execute("SELECT min(%s) FROM %s" % (self.qn(self.column), self.qn(old_table))).fetchone()[0]
+        self.create_partitions(since)
+        self.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s DEFAULT" % (
+            self.qn('%s_default' % self.table), self.qn(self.table)))
+
+        self.execute("INSERT INTO %s SELECT * FROM %s" % (self.qn(self.table), self.qn(old_table)))
+        self.execute("DROP TABLE %s" % self.qn(old_table))
+        log.debug('Converted table %s into partitioned by %s' % (self.table, self.column))
+        return True
+
+
+class PhotoPartitioner(TablePartitioner):
+
+    """
+    Partitioning of table of photos by date of photo. Queries of PhotoRemoteManager,
+    limited by range of dates, are pruned by database to the partitions of these months
+    """
+    model = Photo
+    field = 'date'
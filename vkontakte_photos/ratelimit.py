@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class TokenBucket(object):
+
+    """
+    Token bucket limiter, allowing `rate` calls per second with bursts up to `capacity` calls
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """
+        Take one token from bucket, return number of seconds to wait until it's available
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait(self):
+        delay = self.consume()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class CircuitBreaker(object):
+
+    """
+    Circuit breaker, opening circuit for key after `failures` consecutive failures for `pause` seconds.
+    After pause the next failure opens circuit again
+    """
+
+    def __init__(self, failures, pause):
+        self.failures = failures
+        self.pause = pause
+        self.failures_counts = {}
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def is_open(self, key):
+        with self.lock:
+            opened = self.opened.get(key)
+            if opened is None:
+                return False
+            if time.time() - opened < self.pause:
+                return True
+            del self.opened[key]
+            self.failures_counts[key] = self.failures - 1
+            return False
+
+    def success(self, key):
+        with self.lock:
+            self.failures_counts.pop(key, None)
+
+    def failure(self, key):
+        """
+        Register failure for key, return True if circuit was opened
+        """
+        with self.lock:
+            self.failures_counts[key] = self.failures_counts.get(key, 0) + 1
+            if self.failures_counts[key] >= self.failures:
+                self.opened[key] = time.time()
+                return True
+            return False
+
+
+class Counters(dict):
+
+    """
+    Thread-safe dictionary of counters
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Counters, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self[name] = self.get(name, 0) + value
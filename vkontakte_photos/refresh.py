@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from datetime import timedelta
+import logging
+import os
+import socket
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connections, router
+from django.db.models import Q
+from django.utils import timezone
+from vkontakte_api.decorators import atomic
+
+from .mixins import RateLimitManagerMixin
+from .models import Album, Photo, RefreshLock
+from .routers import SHARD_DATABASES, use_primary, use_shard
+
+log = logging.getLogger('vkontakte_photos')
+
+REFRESH_BATCH_SIZE = getattr(settings, 'VKONTAKTE_PHOTOS_REFRESH_BATCH_SIZE', 25)
+REFRESH_LOCK_TIMEOUT = getattr(settings, 'VKONTAKTE_PHOTOS_REFRESH_LOCK_TIMEOUT', 600)  # seconds
+
+# Adaptive scheduling of refreshes
+REFRESH_MIN_INTERVAL = getattr(settings, 'VKONTAKTE_PHOTOS_REFRESH_MIN_INTERVAL', 600)  # seconds
+REFRESH_MAX_INTERVAL = getattr(settings, 'VKONTAKTE_PHOTOS_REFRESH_MAX_INTERVAL', 7 * 24 * 60 * 60)  # seconds
+REFRESH_AGE_RATIO = getattr(settings, 'VKONTAKTE_PHOTOS_REFRESH_AGE_RATIO', 0.1)
+REFRESH_CHANGES = getattr(settings, 'VKONTAKTE_PHOTOS_REFRESH_CHANGES', 10)
+
+
+class RefreshQueue(object):
+
+    """
+    Abstract queue of instances of `model` ordered by staleness of field `fetched`, subclasses define method
+    `refresh`. Every worker claims the stalest batch of instances, not claimed by other workers, refreshes it
+    and releases it. On PostgreSQL 9.5+ batch is claimed by short transaction, which selects rows by
+    SELECT ... FOR UPDATE SKIP LOCKED and stamps lease of `lock_timeout` seconds in `refresh_after`,
+    on other databases claimed instances are stored in table of RefreshLock. Instances of died workers
+    are claimed again after `lock_timeout` seconds, as well as instances of batch, failed by refresh.
+    With sharding every batch is claimed from one shard, shards are claimed in turn. Only instances with due time
+    of the next refresh
+    `refresh_after` are claimed, after refresh the next time is scheduled according to change rate of instance:
+    interval between refreshes grows with age of the last change `refresh_date_field` of model and shrinks
+    with growth rate of counter `refresh_counter_field`, so that about `REFRESH_CHANGES` changes of counter
+    happen between refreshes of hot instances
+    """
+    __metaclass__ = ABCMeta
+
+    model = None
+    claim_attempts = 10  # attempts of claiming by RefreshLock, conflicting with other workers
+
+    def __init__(self, batch_size=REFRESH_BATCH_SIZE, lock_timeout=REFRESH_LOCK_TIMEOUT, worker=None):
+        self.batch_size = batch_size
+        self.lock_timeout = lock_timeout
+        self.worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.shard_index = 0
+
+    def get_databases(self):
+        """
+        Return databases of instances in order of claiming: all shards starting from the next one
+        after the last claimed or database of writes of model without sharding
+        """
+        shards = list(SHARD_DATABASES) or [None]
+        shards = shards[self.shard_index:] + shards[:self.shard_index]
+        databases = []
+        for shard in shards:
+            with use_shard(shard):
+                databases += [router.db_for_write(self.model)]
+        return databases
+
+    def get_queryset(self, database):
+        queryset = self.model.objects.using(database) \
+            .filter(Q(refresh_after__isnull=True) | Q(refresh_after__lte=timezone.now()))
+        if 'archived' in self.model._meta.get_all_field_names():
+            queryset = queryset.filter(archived=False)
+        return queryset
+
+    def skip_locked_supported(self, database):
+        connection = connections[database]
+        if connection.vendor != 'postgresql':
+            return False
+        connection.cursor()
+        return getattr(connection, 'pg_version', 0) >= 90500
+
+    def get_stalest_ids(self, queryset):
+        fetched = connections[queryset.db].ops.quote_name(self.model._meta.get_field('fetched').column)
+        queryset = queryset.extra(select={'never_fetched': '%s IS NULL' % fetched},
+                                  order_by=['-never_fetched', 'fetched'])
+        return [pk for pk, never_fetched in queryset.values_list('pk', 'never_fetched')[:self.batch_size]]
+
+    def claim_skip_locked(self, database):
+        """
+        Claim batch by setting `refresh_after` of its rows to the end of lease, rows locked by transactions
+        of claiming of other workers are skipped. Locks are released right after claiming
+        """
+        connection = connections[database]
+        qn = connection.ops.quote_name
+        sql, params = self.get_queryset(database).values_list('pk').query.sql_with_params()
+        with atomic(using=database):
+            cursor = connection.cursor()
+            cursor.execute('UPDATE %(table)s SET %(refresh_after)s = %%s WHERE %(pk)s IN ('
+                           'SELECT %(pk)s FROM %(table)s WHERE %(pk)s IN (%(sql)s) '
+                           'ORDER BY %(fetched)s ASC NULLS FIRST LIMIT %(limit)d FOR UPDATE SKIP LOCKED) '
+                           'RETURNING %(pk)s' % {
+                               'pk': qn(self.model._meta.pk.column),
+                               'table': qn(self.model._meta.db_table),
+                               'sql': sql,
+                               'fetched': qn(self.model._meta.get_field('fetched').column),
+                               'refresh_after': qn(self.model._meta.get_field('refresh_after').column),
+                               'limit': self.batch_size,
+                           }, [timezone.now() + timedelta(seconds=self.lock_timeout)] + list(params))
+            return [row[0] for row in cursor.fetchall()]
+
+    def claim_lock_table(self, database):
+        content_type = ContentType.objects.get_for_model(self.model)
+        for attempt in range(self.claim_attempts):
+            now = timezone.now()
+            try:
+                with atomic(using=router.db_for_write(RefreshLock)):
+                    RefreshLock.objects.filter(locked__lt=now - timedelta(seconds=self.lock_timeout)).delete()
+                    locked = RefreshLock.objects.filter(content_type=content_type).values_list('object_id', flat=True)
+                    ids = self.get_stalest_ids(self.get_queryset(database).exclude(pk__in=list(locked)))
+                    RefreshLock.objects.bulk_create([RefreshLock(content_type=content_type, object_id=id,
+                                                                 worker=self.worker, locked=now) for id in ids])
+                return ids
+            except IntegrityError:
+                # another worker claimed some of the same instances at the same moment, its locks are excluded now
+                log.debug('Worker %s lost race for instances of %s, attempt %d' % (
+                    self.worker, self.model.__name__, attempt + 1))
+        raise IntegrityError('Worker %s failed to claim instances of %s in %d attempts' % (
+            self.worker, self.model.__name__, self.claim_attempts))
+
+    def release_lock_table(self, ids):
+        RefreshLock.objects.filter(content_type=ContentType.objects.get_for_model(self.model),
+                                   object_id__in=ids, worker=self.worker).delete()
+
+    def mark_fetched(self, database, ids, started):
+        self.model.objects.using(database).filter(Q(fetched__isnull=True) | Q(fetched__lt=started), pk__in=ids) \
+            .update(fetched=timezone.now())
+
+    def postpone(self, database, ids):
+        """
+        Postpone the next claiming of failed batch for `lock_timeout` seconds, as lease of died worker
+        """
+        self.model.objects.using(database).filter(pk__in=ids) \
+            .update(refresh_after=timezone.now() + timedelta(seconds=self.lock_timeout))
+
+    def get_refresh_interval(self, instance, previous=None):
+        """
+        Return interval before the next refresh of `instance`, `previous` is the state of it before the last refresh
+        """
+        now = timezone.now()
+        date = getattr(instance, instance.refresh_date_field) or now
+        interval = (now - date).total_seconds() * REFRESH_AGE_RATIO
+
+        if previous and previous.fetched:
+            counter = instance.refresh_counter_field
+            growth = (getattr(instance, counter) or 0) - (getattr(previous, counter) or 0)
+            elapsed = (now - previous.fetched).total_seconds()
+            if growth > 0 and elapsed > 0:
+                interval = min(interval, REFRESH_CHANGES * elapsed / growth)
+
+        return timedelta(seconds=max(REFRESH_MIN_INTERVAL, min(REFRESH_MAX_INTERVAL, interval)))
+
+    def schedule(self, database, instances):
+        """
+        Set time of the next refresh of refreshed `instances`, updating instances with the same
+        interval in minutes by one statement
+        """
+        now = timezone.now()
+        refreshed = self.model.objects.using(database).in_bulk([instance.pk for instance in instances])
+        intervals = {}
+        for previous in instances:
+            instance = refreshed.get(previous.pk)
+            if instance:
+                minutes = int(self.get_refresh_interval(instance, previous).total_seconds()) // 60
+                intervals.setdefault(minutes, []).append(instance.pk)
+
+        for minutes, ids in intervals.items():
+            self.model.objects.using(database).filter(pk__in=ids).update(refresh_after=now + timedelta(minutes=minutes))
+
+    @contextmanager
+    def claim(self):
+        """
+        Context manager, claiming the stalest batch of instances for the time of block.
+        Refreshing in the block isn't wrapped into transaction of claiming.
+        Instances, not refreshed inside the block without errors, are marked as fetched to move them
+        to the end of queue. The next refresh of all instances of batch is scheduled after the block.
+        Instances of failed block are claimed again after `lock_timeout` seconds
+        """
+        started = timezone.now()
+        with use_primary():
+            databases = self.get_databases()
+            for i, database in enumerate(databases):
+                skip_locked = self.skip_locked_supported(database)
+                ids = self.claim_skip_locked(database) if skip_locked else self.claim_lock_table(database)
+                if ids:
+                    self.shard_index = (self.shard_index + i + 1) % len(databases)
+                    break
+
+            try:
+                instances = list(self.model.objects.using(database).filter(pk__in=ids))
+                yield instances
+                self.mark_fetched(database, ids, started)
+                self.schedule(database, instances)
+            except Exception:
+                # lease of skip-locked claiming isn't prolonged by failure
+                if not skip_locked:
+                    self.postpone(database, ids)
+                raise
+            finally:
+                if not skip_locked:
+                    self.release_lock_table(ids)
+
+        log.debug('Worker %s refreshed %d instances of %s' % (self.worker, len(ids), self.model.__name__))
+
+    @abstractmethod
+    def refresh(self, instances):
+        """
+        Fetch claimed `instances` from API
+        """
+
+    def get_calls(self):
+        return RateLimitManagerMixin.counters.get('calls', 0)
+
+    def run(self, batches=None, budget=None):
+        """
+        Refresh batches of the stalest due instances until queue is empty, `batches` batches are refreshed
+        or `budget` API calls are spent. Return number of refreshed instances
+        """
+        count = 0
+        calls = self.get_calls()
+        while batches is None or batches > 0:
+            if budget is not None and self.get_calls() - calls >= budget:
+                break
+            with self.claim() as instances:
+                if instances:
+                    self.refresh(instances)
+            if not instances:
+                break
+            count += len(instances)
+            if batches is not None:
+                batches -= 1
+        return count
+
+
+class AlbumRefreshQueue(RefreshQueue):
+
+    """
+    Queue refreshing albums and their photos
+    """
+    model = Album
+
+    def refresh(self, albums):
+        owners = {}
+        for album in albums:
+            owners.setdefault(album.owner, []).append(album.remote_id)
+        for owner, ids in owners.items():
+            Album.remote.fetch(owner=owner, ids=ids)
+        # albums are loaded again with sizes, refreshed by fetching of them. Counters of photos
+        # are returned only by extended response, scheduling depends on growth of them
+        Photo.remote.fetch_for_albums(Album.objects.using(albums[0]._state.db).filter(
+            pk__in=[album.pk for album in albums]), extended=True)
+
+
+class PhotoRefreshQueue(RefreshQueue):
+
+    """
+    Queue refreshing photos
+    """
+    model = Photo
+
+    def refresh(self, photos):
+        albums = {}
+        for photo in photos:
+            albums.setdefault(photo.album, []).append(photo.remote_id)
+        for album, ids in albums.items():
+            Photo.remote.fetch(album=album, ids=ids, extended=True)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.functional import wraps
+
+PRIMARY_DATABASE = getattr(settings, 'VKONTAKTE_PHOTOS_PRIMARY_DATABASE', DEFAULT_DB_ALIAS)
+REPLICA_DATABASES = getattr(settings, 'VKONTAKTE_PHOTOS_REPLICA_DATABASES', [])
+SHARD_DATABASES = getattr(settings, 'VKONTAKTE_PHOTOS_SHARD_DATABASES', [])
+SHARD_CACHE_TIMEOUT = getattr(settings, 'VKONTAKTE_PHOTOS_SHARD_CACHE_TIMEOUT', 60)  # seconds
+
+_local = threading.local()
+_placements = {}
+
+
+class RoutingContext(object):
+
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+
+        return wraps(func)(wrapper)
+
+
+class use_primary(RoutingContext):
+
+    """
+    Context manager and decorator, routing reads of models of the app in the current thread to primary database.
+    Wraps fetching and other read-modify-write paths to read rows just written by them without replication lag
+    """
+
+    def __enter__(self):
+        _local.pinned = getattr(_local, 'pinned', 0) + 1
+
+    def __exit__(self, *args):
+        _local.pinned -= 1
+
+
+class use_shard(RoutingContext):
+
+    """
+    Context manager and decorator, routing queries of sharded models in the current thread to shard `database`.
+    Shard None keeps the current routing
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        _local.shards = getattr(_local, 'shards', []) + [self.database or get_current_shard()]
+
+    def __exit__(self, *args):
+        _local.shards = _local.shards[:-1]
+
+
+def get_current_shard():
+    shards = getattr(_local, 'shards', None)
+    return shards[-1] if shards else None
+
+
+def get_current_database():
+    """
+    Return database of the current shard or primary database, if queries are not routed to shard
+    """
+    return get_current_shard() or PRIMARY_DATABASE
+
+
+def get_hash_shard(owner_content_type_id, owner_id):
+    key = '%s:%s' % (owner_content_type_id, owner_id)
+    return SHARD_DATABASES[int(hashlib.md5(key).hexdigest(), 16) % len(SHARD_DATABASES)]
+
+
+def get_shard(owner_content_type_id, owner_id):
+    """
+    Return shard database of owner: placement, stored by rebalancing in OwnerShard, or shard by hash of owner.
+    Placements are cached by process for SHARD_CACHE_TIMEOUT seconds
+    """
+    if not SHARD_DATABASES:
+        return None
+
+    key = (owner_content_type_id, owner_id)
+    database, expires = _placements.get(key, (None, 0))
+    if expires < time.time():
+        from .models import OwnerShard
+        databases = OwnerShard.objects.using(PRIMARY_DATABASE) \
+            .filter(owner_content_type_id=owner_content_type_id, owner_id=owner_id).values_list('database', flat=True)
+        database = databases[0] if databases else get_hash_shard(owner_content_type_id, owner_id)
+        _placements[key] = database, time.time() + SHARD_CACHE_TIMEOUT
+    return database
+
+
+def clear_shards_cache():
+    _placements.clear()
+
+
+def get_object_shard(obj):
+    """
+    Return shard database of owner, or of album, photo or other instance with owner
+    """
+    if not SHARD_DATABASES or obj is None:
+        return None
+    if hasattr(obj, 'owner_content_type_id'):
+        # owners are not sharded, so database of owner is not its shard, even if it's among shards
+        if obj._state.db in SHARD_DATABASES:
+            return obj._state.db
+        return get_shard(obj.owner_content_type_id, obj.owner_id)
+    from django.contrib.contenttypes.models import ContentType
+    return get_shard(ContentType.objects.get_for_model(obj).pk, obj.pk)
+
+
+def is_primary_pinned():
+    return getattr(_local, 'pinned', 0) > 0 \
+        or getattr(connections[PRIMARY_DATABASE], 'in_atomic_block', False)
+
+
+class ReplicaRouter(object):
+
+    """
+    Database router, sending reads of albums, photos and other models of the app to random replica database
+    from VKONTAKTE_PHOTOS_REPLICA_DATABASES and writes to primary one. Reads are sent to primary inside
+    `use_primary` blocks, transactions and for relations of instances, loaded from primary. Usage:
+
+        DATABASE_ROUTERS = ['vkontakte_photos.routers.ReplicaRouter']
+    """
+    app_labels = ('vkontakte_photos',)
+
+    def is_routed(self, model):
+        return model._meta.app_label in self.app_labels
+
+    def db_for_read(self, model, **hints):
+        if not self.is_routed(model):
+            return None
+        if not REPLICA_DATABASES or is_primary_pinned():
+            return PRIMARY_DATABASE
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db == PRIMARY_DATABASE:
+            return PRIMARY_DATABASE
+        return random.choice(REPLICA_DATABASES)
+
+    def db_for_write(self, model, **hints):
+        if not self.is_routed(model):
+            return None
+        return PRIMARY_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [PRIMARY_DATABASE] + list(REPLICA_DATABASES)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if not self.is_routed(model):
+            return None
+        return db == PRIMARY_DATABASE
+
+    def allow_migrate(self, db, model):
+        return self.allow_syncdb(db, model)
+
+
+class ShardRouter(object):
+
+    """
+    Database router, placing albums, photos and their related rows in shard databases from
+    VKONTAKTE_PHOTOS_SHARD_DATABASES, chosen by owner. Instances are routed by their owner,
+    querysets inside `use_shard` blocks, entered by manager methods of owner. Usage:
+
+        DATABASE_ROUTERS = ['vkontakte_photos.routers.ShardRouter', 'vkontakte_photos.routers.ReplicaRouter']
+    """
+    app_labels = ('vkontakte_photos',)
+    unsharded_models = ('refreshlock', 'ownershard', 'callbackevent')
+
+    def is_sharded(self, model):
+        return bool(SHARD_DATABASES) and model._meta.app_label in self.app_labels \
+            and model._meta.object_name.lower() not in self.unsharded_models
+
+    def get_database(self, model, hints):
+        if not self.is_sharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and self.is_sharded(instance.__class__):
+            if instance._state.db:
+                return instance._state.db
+            if getattr(instance, 'owner_id', None) and getattr(instance, 'owner_content_type_id', None):
+                return get_shard(instance.owner_content_type_id, instance.owner_id)
+        return get_current_shard()
+
+    def db_for_read(self, model, **hints):
+        return self.get_database(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.get_database(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self.is_sharded(obj1.__class__) or self.is_sharded(obj2.__class__):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db not in SHARD_DATABASES or model._meta.app_label not in self.app_labels:
+            return None
+        return self.is_sharded(model)
+
+    def allow_migrate(self, db, model):
+        return self.allow_syncdb(db, model)
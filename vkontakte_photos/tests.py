@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
+from datetime import date, datetime, timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, router
 from django.test import TestCase
+from django.test.client import RequestFactory
 from django.utils import timezone
 from os.path import join, dirname
 
@@ -7,11 +13,24 @@ import mock
 from vkontakte_groups.factories import GroupFactory
 
 import simplejson as json
+from vkontakte_api.api import api_call, VkontakteError
+from vkontakte_comments.factories import CommentFactory
 from vkontakte_comments.models import Comment
 from vkontakte_users.factories import UserFactory, User
 from vkontakte_users.tests import user_fetch_mock
+from . callback import CallbackHandler
+from . decorators import split_by_shards
+from . exceptions import VkontakteCircuitOpenError
 from . factories import AlbumFactory, PhotoFactory
-from . models import Album, Photo
+from . mixins import UPDATE_FIELDS_SUPPORTED
+from . models import Album, CallbackEvent, OwnerShard, Photo, PhotoArchive, PhotoTag, RefreshLock
+from . partitioning import PhotoPartitioner, get_months
+from . ratelimit import CircuitBreaker, Counters, TokenBucket
+from . refresh import AlbumRefreshQueue, PhotoRefreshQueue, RefreshQueue
+from . routers import (ReplicaRouter, ShardRouter, clear_shards_cache, get_object_shard, get_shard, use_primary,
+                       use_shard)
+from . import views
+from . views import callback
 
 
 GROUP_ID = 16297716
@@ -70,6 +89,74 @@ class VkontaktePhotosTest(TestCase):
         self.assertEqual(albums.count(), Album.objects.count())
         self.assertLess(albums.count(), albums_count)
 
+    def test_fetch_group_albums_pages(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+
+        albums = Album.remote.fetch(owner=group)
+        albums_ids = list(albums.values_list('pk', flat=True))
+        self.assertGreater(len(albums_ids), 10)
+        Album.objects.all().delete()
+
+        with mock.patch('vkontakte_photos.models.AlbumRemoteManager.api_call', side_effect=Album.remote.api_call) as api_call:
+            albums = Album.remote.fetch(owner=group, count=10)
+            self.assertEqual(api_call.call_count, len(albums_ids) / 10 + 1)
+
+        self.assertItemsEqual(albums.values_list('pk', flat=True), albums_ids)
+        self.assertEqual(Album.objects.count(), len(albums_ids))
+
+        # system albums are not saved
+        albums = Album.remote.fetch(owner=group, count=10, need_system=True)
+        self.assertEqual(albums.filter(remote_id__lt=0).count(), 0)
+        self.assertEqual(albums.count(), len(albums_ids))
+
+    def test_fetch_albums_for_owners(self):
+
+        groups = [GroupFactory(remote_id=GROUP_ID), GroupFactory(remote_id=GROUP_CRUD_ID)]
+        user = UserFactory(remote_id=USER_AUTHOR_ID)
+
+        with mock.patch('vkontakte_photos.mixins.api_call', side_effect=api_call) as execute:
+            albums = Album.remote.fetch_for_owners(groups + [user])
+            self.assertEqual(execute.call_count, 1)
+
+        self.assertIsInstance(albums, list)
+        self.assertEqual(len(albums), Album.objects.count())
+        for group in groups:
+            self.assertGreater(len([album for album in albums if album.owner_id == group.pk]), 0)
+
+        albums_count = len(albums)
+        Album.objects.all().delete()
+        for owner in groups + [user]:
+            Album.remote.fetch(owner=owner)
+        self.assertEqual(Album.objects.count(), albums_count)
+
+    def test_sync_group_albums(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        albums = [AlbumFactory(remote_id=id, owner=group) for id in [1, 2, 3]]
+        album_other = AlbumFactory(remote_id=4, owner=GroupFactory(remote_id=GROUP_CRUD_ID))
+        photos = [PhotoFactory(remote_id=id, album=album, owner=group) for id, album in enumerate(albums, 1)]
+        Album.objects.filter(remote_id=3).update(archived=True)
+
+        # the second album was removed, the third one appeared again
+        with mock.patch('vkontakte_photos.models.AlbumRemoteManager.fetch',
+                        return_value=Album.objects.filter(pk__in=[1, 3])):
+            self.assertEqual(Album.remote.sync(group), (2, 1, 1))
+
+        self.assertItemsEqual(Album.objects.filter(archived=True).values_list('pk', flat=True), [2])
+        self.assertItemsEqual(Photo.objects.filter(archived=True).values_list('pk', flat=True), [2])
+        self.assertFalse(Album.objects.get(pk=album_other.pk).archived)
+
+        # albums, which were not requested by filtered fetching, are not archived
+        with self.assertRaises(ValueError):
+            Album.remote.sync(group, ids=[1])
+        response = {'count': 1, 'items': [{'id': 1, 'thumb_id': 0, 'owner_id': -GROUP_ID, 'title': 'title',
+                                           'description': '', 'created': 1298365200, 'updated': 1298365201,
+                                           'size': 1, 'privacy': 0}]}
+        with mock.patch('vkontakte_photos.models.AlbumRemoteManager.execute', return_value=[response]):
+            Album.remote.fetch_for_owners([group], album_ids='1')
+        self.assertItemsEqual(Album.objects.filter(archived=True).values_list('pk', flat=True), [2])
+
     def test_fetch_group_photos(self):
 
         group = GroupFactory(remote_id=GROUP_ID)
@@ -108,6 +195,161 @@ class VkontaktePhotosTest(TestCase):
         self.assertEqual(photos.count(), Photo.objects.count())
         self.assertLess(photos.count(), photos_count)
 
+    def test_fetch_group_photos_commit_every(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+
+        photos = album.fetch_photos()
+        photos_ids = list(photos.values_list('pk', flat=True))
+        Photo.objects.all().delete()
+
+        # commit every 3 rows
+        photos = album.fetch_photos(commit_every=3)
+        self.assertGreater(photos.count(), 3)
+        self.assertEqual(photos.count(), Photo.objects.count())
+        self.assertItemsEqual(photos.values_list('pk', flat=True), photos_ids)
+
+        # commit every page
+        Photo.objects.all().delete()
+        photos = album.fetch_photos(all=True, commit_every='page')
+        self.assertEqual(photos.count(), Photo.objects.count())
+        self.assertGreaterEqual(photos.count(), len(photos_ids))
+
+        with self.assertRaises(ValueError):
+            album.fetch_photos(commit_every=0)
+
+    def test_fetch_group_photos_skip_unchanged(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+
+        photos = album.fetch_photos()
+        photo = photos[0]
+        self.assertEqual(photo.fingerprint, photo.get_fingerprint())
+        self.assertEqual(len(photo.fingerprint), 32)
+        fetched = Photo.objects.order_by('-fetched')[0].fetched
+
+        with mock.patch('vkontakte_photos.models.Photo.save') as save:
+            photos_unchanged = album.fetch_photos()
+            self.assertEqual(save.call_count, 0)
+
+        self.assertItemsEqual(photos_unchanged, photos)
+        self.assertGreater(Photo.objects.order_by('fetched')[0].fetched, fetched)
+
+        Photo.objects.filter(pk=photo.pk).update(fingerprint='')
+        with mock.patch('vkontakte_photos.models.Photo.save') as save:
+            album.fetch_photos()
+            self.assertEqual(save.call_count, 1)
+
+        # counters, changed by raw UPDATE, are written over unchanged fingerprint
+        Photo.update_counters('likes_count', {photo.pk: photo.likes_count + 100})
+        with mock.patch('vkontakte_photos.models.Photo.save') as save:
+            album.fetch_photos()
+            self.assertEqual(save.call_count, 0)
+        self.assertEqual(Photo.objects.get(pk=photo.pk).likes_count, photo.likes_count)
+
+    def test_iter_fetch_group_photos(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+
+        pages = 0
+        photos_count = 0
+        for photos in Photo.remote.iter_fetch(album=album, count=5):
+            self.assertLessEqual(len(photos), 5)
+            self.assertTrue(all([photo.pk for photo in photos]))
+            pages += 1
+            photos_count += len(photos)
+
+        self.assertGreater(pages, 1)
+        self.assertEqual(Photo.objects.count(), photos_count)
+
+        counts = list(Photo.remote.iter_fetch(album=album, count=5, as_counts=True))
+        self.assertEqual(len(counts), pages)
+        self.assertEqual(sum(counts), photos_count)
+
+        # timeline arguments filter photos instead of being sent to API
+        after = Photo.objects.order_by('date')[photos_count // 2].date
+        Photo.objects.all().delete()
+        photos = sum(Photo.remote.iter_fetch(album=album, count=5, after=after), [])
+        self.assertTrue(all([photo.date >= after for photo in photos]))
+        self.assertLess(len(photos), photos_count)
+        self.assertEqual(Photo.objects.count(), len(photos))
+
+    def test_fetch_group_photos_parallel(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = Album.remote.fetch(owner=group, ids=[ALBUM_ID])[0]
+        self.assertGreater(album.size, 10)
+
+        photos = album.fetch_photos(all=True, count=10)
+        photos_ids = list(photos.values_list('pk', flat=True))
+        Photo.objects.all().delete()
+
+        photos = album.fetch_photos(workers=3, count=10)
+        self.assertEqual(photos.count(), Photo.objects.count())
+        self.assertItemsEqual(photos.values_list('pk', flat=True), photos_ids)
+
+        # album has been grown since the last fetching
+        Photo.objects.all().delete()
+        album.size = 5
+        photos = album.fetch_photos(workers=3, count=10)
+        self.assertItemsEqual(photos.values_list('pk', flat=True), photos_ids)
+
+        with self.assertRaises(ValueError):
+            album.fetch_photos(workers=3, count=10, all=True)
+
+    def test_fetch_for_albums(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        albums = Album.remote.fetch(owner=group)
+        albums_small = albums.filter(size__lte=100)
+        self.assertGreater(albums_small.count(), 1)
+
+        with mock.patch('vkontakte_photos.mixins.api_call', side_effect=api_call) as execute:
+            photos = Photo.remote.fetch_for_albums(albums_small)
+            self.assertLess(execute.call_count, albums_small.count())
+
+        self.assertEqual(len(photos), Photo.objects.count())
+        self.assertEqual(len(photos), sum(albums_small.values_list('size', flat=True)))
+        self.assertItemsEqual(set([photo.album_id for photo in photos]),
+                              albums_small.filter(size__gt=0).values_list('pk', flat=True))
+
+    def test_discover_group_photos(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        response = {'items': [{'type': 'photo', 'source_id': -GROUP_ID, 'photos': {'count': 2, 'items': [
+            {'id': PHOTO_ID, 'album_id': ALBUM_ID, 'owner_id': -GROUP_ID},
+            {'id': 1, 'album_id': -7, 'owner_id': -GROUP_ID},
+        ]}}]}
+
+        with mock.patch('vkontakte_photos.models.api_call', return_value=response) as newsfeed:
+            photos = Photo.remote.discover([group], start_time=timezone.now())
+            self.assertEqual(newsfeed.call_count, 1)
+            self.assertEqual(newsfeed.call_args[0][0], 'newsfeed.get')
+            self.assertEqual(newsfeed.call_args[1]['source_ids'], str(-GROUP_ID))
+
+        self.assertEqual(Album.objects.count(), 1)
+        self.assertEqual(Album.objects.get().remote_id, ALBUM_ID)
+        self.assertGreater(len(photos), 0)
+        self.assertEqual(len(photos), Photo.objects.filter(album_id=ALBUM_ID).count())
+
+    def test_fetch_all_for_owner(self):
+
+        group = GroupFactory(remote_id=GROUP_CRUD_ID)
+
+        self.assertEqual(Photo.objects.count(), 0)
+        self.assertEqual(Album.objects.count(), 0)
+
+        photos = Photo.remote.fetch_all_for_owner(group)
+
+        self.assertGreater(photos.count(), 0)
+        self.assertEqual(photos.count(), Photo.objects.count())
+        self.assertEqual(photos[0].owner, group)
+        self.assertEqual(Album.objects.count(), len(set(photos.values_list('album_id', flat=True))))
+        self.assertEqual(Album.objects.filter(owner_id=group.pk).count(), Album.objects.count())
+
     @mock.patch('vkontakte_users.models.User.remote._fetch', side_effect=user_fetch_mock)
     def test_fetch_photo_comments(self, *kwargs):
 
@@ -157,6 +399,172 @@ class VkontaktePhotosTest(TestCase):
         self.assertEqual(photo.likes_count, User.objects.count() - users_initial)
         self.assertEqual(photo.likes_count, photo.likes_users.count())
 
+    def test_fetch_album_comments(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        photo = PhotoFactory(remote_id=PHOTO_ID, album=album, owner=group, likes_count=2)
+
+        items = [
+            {'id': 1, 'pid': PHOTO_ID, 'from_id': USER_AUTHOR_ID, 'date': 1298365200, 'text': 'first',
+             'likes': {'count': 1}},
+            {'id': 2, 'pid': PHOTO_ID, 'from_id': -GROUP_ID, 'date': 1298365300, 'text': 'second'},
+            {'id': 3, 'pid': 1, 'from_id': USER_AUTHOR_ID, 'date': 1298365400, 'text': 'comment of unknown photo'},
+        ]
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', return_value=items) as api_call:
+            comments = album.fetch_comments()
+            self.assertEqual(api_call.call_count, 1)
+            self.assertEqual(api_call.call_args[1]['album_id'], ALBUM_ID)
+
+        self.assertEqual(comments.count(), 2)
+        self.assertEqual(Comment.objects.count(), 2)
+        comment = Comment.objects.get(remote_id='-%s_1' % GROUP_ID)
+        self.assertEqual(comment.object, photo)
+        self.assertEqual(comment.author, User.objects.get(remote_id=USER_AUTHOR_ID))
+        self.assertEqual(comment.likes_count, 1)
+        self.assertEqual(Comment.objects.get(remote_id='-%s_2' % GROUP_ID).author, group)
+
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.comments_count, 2)
+        self.assertEqual(photo.actions_count, 4)
+
+        # edited comment
+        items[0]['text'] = 'edited'
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.api_call', return_value=items[:2]):
+            Photo.remote.fetch_all_comments(owner=group)
+        self.assertEqual(Comment.objects.count(), 2)
+        self.assertEqual(Comment.objects.get(remote_id='-%s_1' % GROUP_ID).text, 'edited')
+        self.assertEqual(Photo.objects.get(pk=photo.pk).comments_count, 2)
+
+    def test_sync_album_photos(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        photos = [PhotoFactory(remote_id=id, album=album, owner=group) for id in [1, 2, 3, 4]]
+        photo_other = PhotoFactory(remote_id=5, album=AlbumFactory(remote_id=1, owner=group), owner=group)
+        Photo.objects.filter(remote_id=4).update(archived=True)
+
+        # the third photo was removed, the fourth one appeared again
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.iter_fetch',
+                        return_value=iter([photos[:2], photos[3:]])):
+            self.assertEqual(Photo.remote.sync(album), (3, 1, 1))
+
+        self.assertItemsEqual(Photo.objects.filter(archived=True).values_list('pk', flat=True), [3])
+        self.assertFalse(Photo.objects.get(pk=photo_other.pk).archived)
+
+        # photos, which were not requested by filtered fetching, are not archived
+        with self.assertRaises(ValueError):
+            Photo.remote.sync(album, ids=[1])
+        album.size = 200
+        with mock.patch('vkontakte_photos.models.PhotoRemoteManager.iter_fetch', return_value=iter([photos[:1]])):
+            Photo.remote.fetch_for_albums([album], ids=[1])
+        self.assertItemsEqual(Photo.objects.filter(archived=True).values_list('pk', flat=True), [3])
+
+    def test_move_archived_photos(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        fetched = timezone.now() - timedelta(days=60)
+        photos = [PhotoFactory(remote_id=id, album=album, owner=group, fetched=fetched, archived=id < 3)
+                  for id in [1, 2, 3]]
+        # archived recently
+        PhotoFactory(remote_id=4, album=album, owner=group, fetched=timezone.now(), archived=True)
+
+        photo = photos[0]
+        photo.likes_users.through.objects.create(photo=photo, user=UserFactory(remote_id=10), time_from=fetched)
+        comment = CommentFactory(object=photo, owner=group, author=group)
+        PhotoTag.objects.create(photo=photo, remote_id=1)
+
+        self.assertEqual(PhotoArchive.objects.move(batch_size=1), 2)
+        self.assertItemsEqual(Photo.objects.values_list('pk', flat=True), [3, 4])
+        self.assertItemsEqual(PhotoArchive.objects.values_list('pk', flat=True), [1, 2])
+
+        photo = PhotoArchive.objects.get(pk=1)
+        self.assertEqual(photo.album, album)
+        self.assertEqual(photo.owner, group)
+        self.assertEqual(photo.fetched, fetched)
+        self.assertEqual(photo.likes_users.get().remote_id, 10)
+        self.assertEqual(photo.comments.get(), comment)
+        self.assertEqual(PhotoTag.objects.count(), 0)
+
+        # nothing to move
+        self.assertEqual(PhotoArchive.objects.move(), 0)
+
+    def test_partitioned_photos_queries(self):
+
+        self.assertEqual(get_months(datetime(2014, 11, 20), datetime(2015, 2, 1)),
+                         [date(2014, 11, 1), date(2014, 12, 1), date(2015, 1, 1), date(2015, 2, 1)])
+        self.assertEqual(PhotoPartitioner().get_partition_name(date(2015, 2, 1)), 'vkontakte_photos_photo_y2015m02')
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        photos = [PhotoFactory(remote_id=month, album=album, owner=group,
+                               date=datetime(2015, month, 1, tzinfo=timezone.utc)) for month in [1, 3]]
+        queryset = Photo.remote.get_saved_queryset([photo.pk for photo in photos],
+                                                   Photo.remote.get_partition_bounds(photos))
+        self.assertIn('BETWEEN', str(queryset.query))
+        self.assertItemsEqual(queryset, photos)
+
+        # partitions are created only on PostgreSQL 11+ for partitioned table, table of test database isn't converted
+        with self.assertRaises(ImproperlyConfigured):
+            PhotoPartitioner().create_partitions()
+
+    def test_fetch_photos_tags(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        photos = [PhotoFactory(remote_id=id, album=album, owner=group, tags_count=1) for id in [1, 2, 3]]
+        PhotoTag.objects.create(photo=photos[1], remote_id=1, tagged_name='deleted tag')
+
+        tag = {'id': 10, 'user_id': USER_AUTHOR_ID, 'placer_id': 1, 'tagged_name': 'name', 'date': 1298365200,
+               'x': 10.5, 'y': 20, 'x2': 30, 'y2': 40, 'viewed': 1}
+        with mock.patch('vkontakte_photos.mixins.api_call', return_value=[[tag], [], False]) as execute:
+            tags = Photo.remote.fetch_tags(Photo.objects.order_by('pk'))
+            self.assertEqual(execute.call_count, 1)
+
+        self.assertEqual(len(tags), 1)
+        tag = tags[0]
+        self.assertEqual(tag.photo, photos[0])
+        self.assertEqual(tag.user, User.objects.get(remote_id=USER_AUTHOR_ID))
+        self.assertEqual(tag.placer, User.objects.get(remote_id=1))
+        self.assertEqual(tag.x, 10.5)
+        self.assertTrue(tag.viewed)
+
+        # tags count of the third photo is not changed after failed call
+        self.assertEqual([photo.tags_count for photo in Photo.objects.order_by('pk')], [1, 0, 1])
+
+    def test_sync_photo_likes(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        photo = PhotoFactory(remote_id=PHOTO_ID, album=album, owner=group, comments_count=1)
+        through = photo.likes_users.through
+
+        # user 1 left, user 2 stays, users 3-4 are new likers
+        time_from = timezone.now() - timedelta(days=1)
+        for id in [1, 2]:
+            through.objects.create(photo=photo, user=UserFactory(remote_id=id), time_from=time_from)
+
+        photo.likes_page_size = 2
+        with mock.patch('vkontakte_users.models.User.remote.fetch_likes_user_ids', side_effect=[[2, 3], [4]]) as fetch:
+            self.assertEqual(photo.sync_likes(), 3)
+            self.assertEqual(fetch.call_count, 2)
+            self.assertEqual(fetch.call_args[1]['offset'], 2)
+
+        self.assertItemsEqual(through.objects.filter(time_to__isnull=True).values_list('user_id', flat=True), [2, 3, 4])
+        self.assertItemsEqual(through.objects.filter(time_to__isnull=False).values_list('user_id', flat=True), [1])
+        self.assertEqual(User.objects.filter(remote_id__in=[3, 4]).count(), 2)
+
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.likes_count, 3)
+        self.assertEqual(photo.actions_count, 4)
+
+        # user 1 likes again
+        with mock.patch('vkontakte_users.models.User.remote.fetch_likes_user_ids', side_effect=[[1, 2], [3, 4], []]):
+            self.assertEqual(photo.sync_likes(), 4)
+        self.assertEqual(through.objects.filter(user_id=1).count(), 2)
+        self.assertEqual(through.objects.filter(time_to__isnull=True).count(), 4)
+
     def test_fetch_photo_likes_parser(self):
 
         group = GroupFactory(remote_id=GROUP_ID)
@@ -177,6 +585,128 @@ class VkontaktePhotosTest(TestCase):
         photo.fetch_comments_parser()
         self.assertGreater(photo.comments_count, 0)
 
+    def test_update_photos_counters(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        photos = [PhotoFactory(remote_id=id, album=album, owner=group, comments_count=id, likes_count=None)
+                  for id in [1, 2, 3]]
+
+        # concurrent change of row isn't overwritten by refresh of counter
+        Photo.objects.filter(pk=photos[0].pk).update(text='changed', comments_count=10)
+        Photo.update_counters('likes_count', {photos[0].pk: 5, photos[1].pk: 5, photos[2].pk: 7})
+
+        photos = Photo.objects.order_by('pk')
+        self.assertEqual([photo.likes_count for photo in photos], [5, 5, 7])
+        self.assertEqual([photo.actions_count for photo in photos], [15, 7, 10])
+        self.assertEqual(photos[0].text, 'changed')
+
+    def test_backfill_photos(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        PhotoFactory(remote_id=1, album=album, owner=group, text='stored', likes_count=10, archived=True)
+
+        photos = [Photo(remote_id=id, album=album, owner=group, text='line\tof\ntext %d' % id, likes_count=id,
+                        date=timezone.now(), fetched=timezone.now()) for id in [1, 2, 3, 3]]
+        photos[-1].likes_count = 30
+        pks = Photo.remote.backfill_instances(photos)
+
+        self.assertEqual(sorted(set(pks)), [1, 2, 3])
+        self.assertEqual(Photo.objects.count(), 3)
+        # stored photo is merged with fetched values
+        photo = Photo.objects.get(remote_id=1)
+        self.assertEqual(photo.text, 'line\tof\ntext 1')
+        self.assertEqual(photo.likes_count, 1)
+        self.assertEqual(photo.fingerprint, photo.get_fingerprint())
+        # local state isn't overwritten by defaults of fetched photo
+        self.assertTrue(photo.archived)
+        self.assertEqual(Photo.objects.get(remote_id=2).album, album)
+        # the last duplicate is saved
+        self.assertEqual(Photo.objects.get(remote_id=3).likes_count, 30)
+
+    def test_backfill_photos_by_copy(self):
+
+        if not Photo.remote.is_copy_supported(connection):
+            self.skipTest('COPY with INSERT ... ON CONFLICT is supported only by PostgreSQL 9.5+')
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        user = UserFactory(remote_id=USER_AUTHOR_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        refresh_after = timezone.now()
+        PhotoFactory(remote_id=1, album=album, owner=group, user=user, text='stored', likes_count=10, archived=True,
+                     refresh_after=refresh_after)
+
+        # staging table is reused by the next pages
+        for likes_count in [20, 30]:
+            photos = [Photo(remote_id=id, album=album, owner=group, text='text %d' % id, likes_count=likes_count,
+                            date=timezone.now(), fetched=timezone.now()) for id in [1, 2, 2]]
+            photos[1].likes_count = 0
+            with mock.patch.object(Photo.remote, 'bulk_create_instances') as bulk_create_instances:
+                self.assertEqual(sorted(Photo.remote.backfill_instances(photos)), [1, 2])
+            self.assertFalse(bulk_create_instances.called)
+
+            self.assertEqual(Photo.objects.count(), 2)
+            photo = Photo.objects.get(remote_id=1)
+            self.assertEqual(photo.likes_count, likes_count)
+            self.assertEqual(photo.text, 'text 1')
+            # stored value is kept for NULL of fetched photo
+            self.assertEqual(photo.user, user)
+            # local state isn't overwritten by defaults of fetched photo
+            self.assertTrue(photo.archived)
+            self.assertEqual(photo.refresh_after, refresh_after)
+            # the last duplicate is merged
+            self.assertEqual(Photo.objects.get(remote_id=2).likes_count, likes_count)
+
+    def test_save_changed_fields(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        PhotoFactory(remote_id=1, album=album, owner=group, text='text', likes_count=1)
+
+        photo = Photo.objects.get(remote_id=1)
+        self.assertEqual(photo.get_changed_fields(), [] if UPDATE_FIELDS_SUPPORTED else None)
+        photo.likes_count = 5
+        if UPDATE_FIELDS_SUPPORTED:
+            self.assertEqual(photo.get_changed_fields(), ['likes_count'])
+
+        # concurrent change of other field isn't overwritten by saving of loaded instance
+        Photo.objects.filter(remote_id=1).update(text='changed')
+        photo.save()
+
+        photo = Photo.objects.get(remote_id=1)
+        self.assertEqual(photo.likes_count, 5)
+        if UPDATE_FIELDS_SUPPORTED:
+            self.assertEqual(photo.text, 'changed')
+            self.assertEqual(photo.get_changed_fields(), [])
+
+    def test_save_changed_fields_of_fetched_photos(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        stored = PhotoFactory(remote_id=1, album=album, owner=group, text='text', likes_count=1)
+
+        # parsed instance isn't loaded from database, but it's substituted with stored one before saving
+        instance = Photo(**dict([(field.attname, getattr(stored, field.attname)) for field in Photo._meta.fields]))
+        instance.text = 'new text'
+        self.assertTrue(instance._state.adding)
+
+        get_fingerprint = Photo.get_fingerprint
+
+        def concurrent_update(photo):
+            Photo.objects.filter(remote_id=1).update(likes_count=10)
+            return get_fingerprint(photo)
+
+        with mock.patch.object(Photo, 'get_fingerprint', autospec=True, side_effect=concurrent_update):
+            photos = Photo.remote.get_or_create_from_instances([instance])
+
+        self.assertEqual(photos, [instance])
+        self.assertFalse(instance._state.adding)
+        photo = Photo.objects.get(remote_id=1)
+        self.assertEqual(photo.text, 'new text')
+        self.assertEqual(photo.fingerprint, photo.get_fingerprint())
+        self.assertEqual(photo.likes_count, 10 if UPDATE_FIELDS_SUPPORTED else 1)
+
     def test_parse_album(self):
 
         response = '''{"response":[{"id":16178407,"thumb_id":"96509883","owner_id":6492,"title":"qwerty",
@@ -327,6 +857,122 @@ class VkontaktePhotosTest(TestCase):
         self.assertEqual(Comment.objects.count(), 2)
         assert_local_equal_to_remote(comment)
 
+    @mock.patch('time.sleep')
+    def test_api_call_rate_limits(self, sleep):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+
+        error = VkontakteError({'error_code': 29, 'error_msg': 'Rate limit reached', 'request_params': []})
+        retried_error = VkontakteError({'error_code': 6, 'error_msg': 'Too many requests per second',
+                                        'request_params': []})
+        access_error = VkontakteError({'error_code': 15, 'error_msg': 'Access denied', 'request_params': []})
+        counters = Counters()
+        manager = Photo.remote
+
+        with mock.patch.object(manager, 'counters', counters), \
+                mock.patch.object(manager, 'breaker', CircuitBreaker(failures=2, pause=60)), \
+                mock.patch.object(manager, 'limiter', TokenBucket(rate=1000)):
+
+            # backoff on rate limit errors
+            with mock.patch('vkontakte_api.models.VkontakteManager.api_call', side_effect=[error, error, []]):
+                album.fetch_photos()
+            self.assertEqual(counters['retries'], 2)
+            self.assertEqual(counters['calls'], 3)
+            self.assertGreater(sleep.call_args_list[1][0][0], sleep.call_args_list[0][0][0])
+
+            # errors, specific to request, and errors, already retried by api_call, don't open circuit breaker
+            for side_effect in [access_error, retried_error]:
+                with mock.patch('vkontakte_api.models.VkontakteManager.api_call', side_effect=side_effect):
+                    for i in range(3):
+                        with self.assertRaises(VkontakteError):
+                            album.fetch_photos()
+            self.assertNotIn('failures', counters)
+            self.assertEqual(counters['retries'], 2)
+
+            # circuit breaker after repeated failures
+            with mock.patch.object(manager, 'max_retries', 0), \
+                    mock.patch('vkontakte_api.models.VkontakteManager.api_call', side_effect=error):
+                for i in range(2):
+                    with self.assertRaises(VkontakteError):
+                        album.fetch_photos()
+                with self.assertRaises(VkontakteCircuitOpenError):
+                    album.fetch_photos()
+
+        self.assertEqual(counters['failures'], 2)
+        self.assertEqual(counters['circuits_opened'], 1)
+        self.assertEqual(counters['rejected'], 1)
+
+
+class VkontakteCallbackTest(TestCase):
+
+    def post_event(self, event):
+        return callback(RequestFactory().post('/callback/', json.dumps(event), content_type='application/json'))
+
+    @mock.patch('vkontakte_photos.views.CALLBACK_CONFIRMATION', 'code')
+    @mock.patch('vkontakte_photos.views.handler', CallbackHandler(secret='secret', batch_size=2))
+    def test_callback_events(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+
+        response = self.post_event({'type': 'confirmation', 'group_id': GROUP_ID})
+        self.assertEqual(response.content, 'code')
+
+        response = self.post_event({'type': 'photo_new', 'group_id': GROUP_ID, 'secret': 'wrong', 'object': {}})
+        self.assertEqual(response.status_code, 403)
+        with mock.patch('vkontakte_photos.views.handler', CallbackHandler(secret='')):
+            response = self.post_event({'type': 'photo_new', 'group_id': GROUP_ID, 'secret': '', 'object': {}})
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(CallbackEvent.objects.count(), 0)
+
+        photo = {'id': PHOTO_ID, 'album_id': ALBUM_ID, 'owner_id': -GROUP_ID, 'user_id': 100,
+                 'photo_130': 'http://cs9231.vkontakte.ru/m_7875d2fb.jpg', 'text': 'test', 'date': 1298365200}
+        response = self.post_event({'type': 'photo_new', 'group_id': GROUP_ID, 'secret': 'secret', 'object': photo})
+        self.assertEqual(response.content, 'ok')
+        # stored and acknowledged, processed later by flushing
+        self.assertEqual(Photo.objects.count(), 0)
+        self.assertEqual(CallbackEvent.objects.count(), 1)
+
+        comment = {'id': 1, 'photo_id': PHOTO_ID, 'photo_owner_id': -GROUP_ID, 'from_id': USER_AUTHOR_ID,
+                   'date': 1298365300, 'text': 'comment'}
+        self.post_event({'type': 'photo_comment_new', 'group_id': GROUP_ID, 'secret': 'secret', 'object': comment})
+        # photo of service album isn't stored
+        service_photo = dict(photo, id=PHOTO_ID + 1, album_id=-7)
+        self.post_event({'type': 'photo_new', 'group_id': GROUP_ID, 'secret': 'secret', 'object': service_photo})
+        self.assertEqual(CallbackEvent.objects.count(), 3)
+        self.assertEqual(views.handler.flush(), 3)
+
+        self.assertEqual(CallbackEvent.objects.count(), 0)
+        photo = Photo.objects.get(remote_id=PHOTO_ID)
+        self.assertEqual(photo.owner, group)
+        self.assertEqual(photo.album, Album.objects.get(remote_id=ALBUM_ID))
+        self.assertEqual(photo.text, 'test')
+        self.assertEqual(photo.comments_count, 1)
+        self.assertEqual(photo.comments.get().text, 'comment')
+        self.assertEqual(Photo.objects.count(), 1)
+        self.assertEqual(Album.objects.count(), 1)
+
+        comment = {'id': 1, 'photo_id': PHOTO_ID, 'owner_id': -GROUP_ID, 'user_id': USER_AUTHOR_ID}
+        self.post_event({'type': 'photo_comment_delete', 'group_id': GROUP_ID, 'secret': 'secret', 'object': comment})
+        self.post_event({'type': 'photo_comment_delete', 'group_id': GROUP_ID, 'secret': 'secret', 'object': comment})
+        self.assertEqual(views.handler.flush(), 2)
+
+        photo = Photo.objects.get(remote_id=PHOTO_ID)
+        self.assertEqual(photo.comments_count, 0)
+        self.assertTrue(photo.comments.get().archived)
+
+        # malformed event is dropped and doesn't block processing of other events
+        comment = {'id': 1, 'photo_id': PHOTO_ID, 'photo_owner_id': -GROUP_ID, 'from_id': USER_AUTHOR_ID,
+                   'date': 1298365300, 'text': 'comment'}
+        self.post_event({'type': 'photo_comment_new', 'group_id': GROUP_ID, 'secret': 'secret', 'object': {}})
+        response = self.post_event({'type': 'photo_comment_restore', 'group_id': GROUP_ID, 'secret': 'secret',
+                                    'object': comment})
+        self.assertEqual(response.content, 'ok')
+        self.assertEqual(CallbackEvent.objects.count(), 2)
+        self.assertEqual(views.handler.flush(), 1)
+        self.assertEqual(CallbackEvent.objects.count(), 0)
+        self.assertFalse(Photo.objects.get(remote_id=PHOTO_ID).comments.get().archived)
+
 
 class VkontakteUploadPhotos(TestCase):
 
@@ -370,3 +1016,276 @@ class VkontakteUploadPhotos(TestCase):
 
         self.assertEqual(len(photos), len(self.files))
         self.assertEqual(photos[0].text, caption)
+
+
+class VkontakteRefreshQueueTest(TestCase):
+
+    multi_db = True
+
+    def test_claim_stalest_albums(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album1 = AlbumFactory(remote_id=1, owner=group, fetched=None)
+        album2 = AlbumFactory(remote_id=2, owner=group, fetched=timezone.now() - timedelta(days=2))
+        album3 = AlbumFactory(remote_id=3, owner=group, fetched=timezone.now() - timedelta(days=1))
+
+        queue1 = AlbumRefreshQueue(batch_size=2, worker='worker1')
+        queue2 = AlbumRefreshQueue(batch_size=2, worker='worker2')
+
+        skip_locked = queue1.skip_locked_supported('default')
+        with queue1.claim() as albums1:
+            self.assertItemsEqual(albums1, [album1, album2])
+            with queue2.claim() as albums2:
+                self.assertItemsEqual(albums2, [album3])
+            if skip_locked:
+                # leases are stamped by committed transaction of claiming
+                self.assertEqual(Album.objects.filter(refresh_after__gt=timezone.now()).count(), 3)
+            else:
+                self.assertEqual(RefreshLock.objects.count(), 2)
+
+        self.assertEqual(RefreshLock.objects.count(), 0)
+        self.assertEqual(Album.objects.filter(fetched__isnull=True).count(), 0)
+        self.assertEqual(Album.objects.order_by('fetched')[0], album3)
+
+        # refreshed albums are not due
+        self.assertEqual(Album.objects.filter(refresh_after__isnull=True).count(), 0)
+        with queue1.claim() as albums1:
+            self.assertEqual(albums1, [])
+        Album.objects.update(refresh_after=None)
+
+        # expired locks and leases of died workers
+        RefreshLock.objects.create(content_type=ContentType.objects.get_for_model(Album), object_id=album3.pk,
+                                   worker='died', locked=timezone.now() - timedelta(days=1))
+        Album.objects.filter(pk=album3.pk).update(refresh_after=timezone.now() - timedelta(seconds=1))
+        Album.objects.exclude(pk=album3.pk).update(refresh_after=timezone.now() + timedelta(days=1))
+        with queue1.claim() as albums1:
+            self.assertEqual(albums1, [album3])
+        Album.objects.update(refresh_after=None)
+
+        with mock.patch('vkontakte_photos.refresh.AlbumRefreshQueue.refresh') as refresh:
+            self.assertEqual(queue1.run(batches=2), 3)
+            self.assertEqual(refresh.call_count, 2)
+
+        # failed batch isn't claimed again until the end of lock
+        Album.objects.update(refresh_after=None)
+        with self.assertRaises(ValueError):
+            with queue1.claim() as albums1:
+                raise ValueError()
+        self.assertEqual(RefreshLock.objects.count(), 0)
+        self.assertEqual(Album.objects.filter(refresh_after__gt=timezone.now()).count(), 2)
+        with queue2.claim() as albums2:
+            self.assertEqual(len(albums2), 1)
+            self.assertNotIn(albums2[0], albums1)
+
+    def test_claim_lock_table_race(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        AlbumFactory(remote_id=1, owner=group, fetched=None)
+        queue = AlbumRefreshQueue(batch_size=2, worker='worker1')
+
+        # worker, lost race with another worker, claims again instead of stopping as on empty queue
+        bulk_create = RefreshLock.objects.bulk_create
+        attempts = []
+
+        def bulk_create_after_race(locks):
+            attempts.append(locks)
+            if len(attempts) == 1:
+                raise IntegrityError('duplicate key value violates unique constraint')
+            return bulk_create(locks)
+
+        with mock.patch.object(RefreshLock.objects, 'bulk_create', side_effect=bulk_create_after_race):
+            self.assertEqual(len(queue.claim_lock_table('default')), 1)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(RefreshLock.objects.count(), 1)
+
+        with self.assertRaises(TypeError):
+            RefreshQueue()
+
+    def test_refresh_counters(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        photo = PhotoFactory(remote_id=PHOTO_ID, album=album, owner=group, likes_count=3, comments_count=1,
+                             actions_count=4)
+
+        def api_call(*args, **kwargs):
+            resource = {'id': PHOTO_ID, 'album_id': ALBUM_ID, 'owner_id': -GROUP_ID, 'date': 1298365200,
+                        'photo_130': 'http://cs9231.vkontakte.ru/m_7875d2fb.jpg', 'text': 'test'}
+            # counters are returned only by extended response
+            if kwargs.get('extended'):
+                resource.update({'likes': {'user_likes': 0, 'count': 5}, 'comments': {'count': 2}})
+            return [resource]
+
+        with mock.patch('vkontakte_api.models.VkontakteManager.api_call', side_effect=api_call):
+            PhotoRefreshQueue().refresh([photo])
+
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.likes_count, 5)
+        self.assertEqual(photo.comments_count, 2)
+        self.assertEqual(photo.actions_count, 7)
+
+        with mock.patch.object(Album.remote, 'fetch') as fetch_albums, \
+                mock.patch.object(Photo.remote, 'fetch_for_albums') as fetch_for_albums:
+            AlbumRefreshQueue().refresh([album])
+        fetch_albums.assert_called_once_with(owner=group, ids=[album.remote_id])
+        self.assertTrue(fetch_for_albums.call_args[1]['extended'])
+
+    @mock.patch('vkontakte_photos.routers.SHARD_DATABASES', ['default', 'shard'])
+    @mock.patch('vkontakte_photos.refresh.SHARD_DATABASES', ['default', 'shard'])
+    def test_claim_albums_of_shards(self):
+
+        groups = [GroupFactory(remote_id=GROUP_ID), GroupFactory(remote_id=GROUP_CRUD_ID)]
+        content_type_id = ContentType.objects.get_for_model(groups[0]).pk
+        with mock.patch.object(router, 'routers', [ShardRouter()]):
+            for group, database in zip(groups, ['default', 'shard']):
+                OwnerShard.objects.create(owner_content_type_id=content_type_id, owner_id=group.pk, database=database)
+                AlbumFactory(remote_id=group.remote_id, owner=group, fetched=None)
+
+            # shards are claimed in turn
+            queue = AlbumRefreshQueue(batch_size=2)
+            databases = []
+            for i in range(2):
+                with queue.claim() as albums:
+                    self.assertEqual(len(albums), 1)
+                    databases += [albums[0]._state.db]
+            self.assertItemsEqual(databases, ['default', 'shard'])
+
+            with queue.claim() as albums:
+                self.assertEqual(albums, [])
+            self.assertEqual(Album.objects.using('shard').filter(fetched__isnull=True).count(), 0)
+            self.assertEqual(Album.objects.using('shard').filter(refresh_after__isnull=True).count(), 0)
+        clear_shards_cache()
+
+    def test_refresh_interval(self):
+
+        now = timezone.now()
+        queue = PhotoRefreshQueue()
+        previous = Photo(actions_count=50, fetched=now - timedelta(hours=1))
+
+        # hot photo, 50 new actions during the last hour
+        photo = Photo(date=now - timedelta(days=1), actions_count=100)
+        self.assertAlmostEqual(queue.get_refresh_interval(photo, previous).total_seconds(), 10 * 3600 / 50, delta=1)
+
+        # the same photo without new actions
+        photo.actions_count = 50
+        self.assertAlmostEqual(queue.get_refresh_interval(photo, previous).total_seconds(), 0.1 * 24 * 3600, delta=1)
+
+        # new and very old photos
+        photo.date = now
+        self.assertEqual(queue.get_refresh_interval(photo, previous), timedelta(seconds=600))
+        photo.date = now - timedelta(days=1000)
+        self.assertEqual(queue.get_refresh_interval(photo, previous), timedelta(days=7))
+
+        # album without known date of update is hot
+        self.assertEqual(AlbumRefreshQueue().get_refresh_interval(Album(updated=None)), timedelta(seconds=600))
+
+
+class VkontakteReplicaRouterTest(TestCase):
+
+    @mock.patch('vkontakte_photos.routers.REPLICA_DATABASES', ['replica'])
+    @mock.patch('vkontakte_photos.routers.connections', {'default': mock.Mock(in_atomic_block=False)})
+    def test_route_reads_to_replicas(self):
+
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Photo), 'replica')
+        self.assertEqual(router.db_for_read(User), None)
+        self.assertEqual(router.db_for_write(Photo), 'default')
+        self.assertFalse(router.allow_syncdb('replica', Album))
+
+        # read after write
+        with use_primary():
+            self.assertEqual(router.db_for_read(Album), 'default')
+        self.assertEqual(router.db_for_read(Album), 'replica')
+
+        photo = Photo()
+        photo._state.db = 'default'
+        self.assertEqual(router.db_for_read(Photo, instance=photo), 'default')
+
+
+class VkontakteShardRouterTest(TestCase):
+
+    multi_db = True
+
+    def tearDown(self):
+        clear_shards_cache()
+
+    @mock.patch('vkontakte_photos.routers.SHARD_DATABASES', ['shard1', 'shard2'])
+    def test_route_owners_to_shards(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        content_type_id = ContentType.objects.get_for_model(group).pk
+        shard = get_shard(content_type_id, group.pk)
+        self.assertIn(shard, ['shard1', 'shard2'])
+        self.assertEqual(get_object_shard(group), shard)
+
+        router = ShardRouter()
+        album = Album(remote_id=ALBUM_ID, owner_content_type_id=content_type_id, owner_id=group.pk)
+        self.assertEqual(router.db_for_write(Album, instance=album), shard)
+        self.assertEqual(router.db_for_read(Photo), None)
+        self.assertEqual(router.db_for_read(OwnerShard), None)
+        with use_shard('shard2'):
+            self.assertEqual(router.db_for_read(Photo), 'shard2')
+            self.assertEqual(router.db_for_write(RefreshLock), None)
+
+        # placement of owner, moved by rebalancing, is cached
+        other = 'shard1' if shard == 'shard2' else 'shard2'
+        OwnerShard.objects.create(owner_content_type_id=content_type_id, owner_id=group.pk, database=other)
+        self.assertEqual(get_shard(content_type_id, group.pk), shard)
+        clear_shards_cache()
+        self.assertEqual(get_shard(content_type_id, group.pk), other)
+
+    def test_split_by_shards(self):
+
+        groups = [GroupFactory(remote_id=GROUP_ID), GroupFactory(remote_id=GROUP_CRUD_ID)]
+        content_type_id = ContentType.objects.get_for_model(groups[0]).pk
+
+        @split_by_shards
+        def fetch_for_owners(manager, owners):
+            return Album.objects.filter(owner_id__in=[owner.pk for owner in owners])
+
+        # list is returned without sharding
+        albums = fetch_for_owners(None, groups)
+        self.assertEqual(albums, [])
+
+        with mock.patch('vkontakte_photos.routers.SHARD_DATABASES', ['default', 'shard']), \
+                mock.patch('vkontakte_photos.decorators.SHARD_DATABASES', ['default', 'shard']), \
+                mock.patch.object(router, 'routers', [ShardRouter()]):
+            for group, database in zip(groups, ['default', 'shard']):
+                OwnerShard.objects.create(owner_content_type_id=content_type_id, owner_id=group.pk,
+                                          database=database)
+                AlbumFactory(remote_id=group.remote_id, owner=group)
+            self.assertEqual(Album.objects.using('shard').get().owner_id, groups[1].pk)
+
+            # list is returned for any number of shards
+            for owners in [[], groups[:1], groups[1:], groups]:
+                albums = fetch_for_owners(None, owners)
+                self.assertIsInstance(albums, list)
+                self.assertItemsEqual([album.owner_id for album in albums], [owner.pk for owner in owners])
+                for album in albums:
+                    owner = [group for group in groups if group.pk == album.owner_id][0]
+                    self.assertEqual(album._state.db, get_object_shard(owner))
+
+    @mock.patch('vkontakte_photos.routers.SHARD_DATABASES', ['default', 'shard'])
+    def test_move_owner_between_shards(self):
+
+        group = GroupFactory(remote_id=GROUP_ID)
+        content_type_id = ContentType.objects.get_for_model(group).pk
+        owner = {'owner_content_type_id': content_type_id, 'owner_id': group.pk}
+        OwnerShard.objects.create(database='default', **owner)
+
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=group)
+        for id in [1, 2]:
+            PhotoFactory(remote_id=id, album=album, owner=group)
+        self.assertEqual(Photo.objects.using('default').filter(**owner).count(), 2)
+
+        self.assertEqual(OwnerShard.objects.move(content_type_id, group.pk, 'shard', batch_size=1), 3)
+        self.assertEqual(OwnerShard.objects.get(**owner).database, 'shard')
+        self.assertEqual(get_object_shard(group), 'shard')
+
+        self.assertEqual(Album.objects.using('default').filter(**owner).count(), 0)
+        self.assertEqual(Photo.objects.using('default').filter(**owner).count(), 0)
+        self.assertEqual(Album.objects.using('shard').get(**owner).pk, album.pk)
+        self.assertEqual(Photo.objects.using('shard').filter(**owner).count(), 2)
+
+        # moving into the same shard does nothing
+        self.assertEqual(OwnerShard.objects.move(content_type_id, group.pk, 'shard'), 0)
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('vkontakte_photos.views',
+    url(r'^callback/$', 'callback', name='vkontakte_photos_callback'),
+)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .callback import handler, CALLBACK_CONFIRMATION
+
+log = logging.getLogger('vkontakte_photos')
+
+
+@csrf_exempt
+@require_POST
+def callback(request):
+    """
+    Receiver of VK Callback API events
+    """
+    try:
+        event = json.loads(request.body)
+        assert 'type' in event
+    except (TypeError, ValueError, AssertionError):
+        return HttpResponseBadRequest('Wrong format of event')
+
+    if event['type'] == 'confirmation':
+        return HttpResponse(CALLBACK_CONFIRMATION)
+
+    if not handler.secret:
+        log.error('Callback event from group %s is rejected, because VKONTAKTE_PHOTOS_CALLBACK_SECRET is not set'
+                  % event.get('group_id'))
+        return HttpResponseForbidden('Secret key is not configured')
+
+    if not handler.verify(event):
+        log.warning('Callback event with wrong secret key from group %s' % event.get('group_id'))
+        return HttpResponseForbidden('Wrong secret key')
+
+    handler.handle(event)
+    return HttpResponse('ok')